@@ -0,0 +1,93 @@
+"""
+Almacenamiento intercambiable.
+
+Cada backend es un módulo que implementa las funciones de INTERFAZ con los
+mismos datos en crudo (filas clave/valor de config, registros de historial
+con 'fecha', 'usuario', 'json', 'creado', 'actualizado' y eventos de taller
+con 'momento', 'unidad', 'estado', 'usuario'). Las lecturas de historial
+aceptan `columnas` (p. ej. ("creado",)) para devolver solo esos campos más
+'fecha' sin descargar el resto. La lógica de negocio vive en database.py, que
+es lo único que importan las vistas.
+
+Se elige con `almacenamiento = "sheets" | "sqlite"` en st.secrets o con la
+variable de entorno GESTOR_ALMACENAMIENTO. Por defecto, Google Sheets.
+"""
+import os
+import importlib
+import threading
+import streamlit as st
+
+BACKENDS = {
+    "sheets": "almacenamiento.sheets",
+    "sqlite": "almacenamiento.sqlite",
+}
+
+# Separa el usuario del mes en los nombres de partición del historial
+# (Historial_<usuario>#AAAA-MM). No se admite en nombres de usuario: con un
+# separador válido en ellos, el mes de "ana" sería la pestaña de otro usuario.
+SEPARADOR_PARTICION = "#"
+
+INTERFAZ = (
+    "registrar_fallo", "invalidar_usuario",
+    # Usuarios
+    "buscar_usuario", "crear_usuario", "cambiar_password",
+    # Configuración
+    "leer_config", "leer_config_clave", "escribir_config", "actualizar_config",
+    # Historial
+    "leer_historial_dia", "leer_historial_rango",
+    "agregar_historial", "upsert_historial", "eliminar_historial",
+    # Retención (días anteriores a una fecha, para pasarlos al archivo; se
+    # borran solo los (fecha, actualizado) archivados)
+    "leer_historial_anterior", "eliminar_historial_anterior",
+    # Mantenimiento (duplicados fuera, historial ordenado por fecha)
+    "compactar_historial",
+    # Taller (registro de eventos, solo se añade)
+    "leer_eventos_taller", "agregar_eventos_taller",
+    # Arranque (config + taller + día en una lectura)
+    "leer_inicio",
+)
+
+_lock = threading.Lock()
+_activo = None
+
+def leer_ajuste(clave, defecto=None):
+    """Variable de entorno GESTOR_<CLAVE>, luego st.secrets[clave], luego el defecto."""
+    valor = os.environ.get(f"GESTOR_{clave.upper()}")
+    if valor: return valor
+    try:
+        if clave in st.secrets: return st.secrets[clave]
+    except Exception: pass
+    return defecto
+
+def obtener_backend():
+    global _activo
+    if _activo is not None: return _activo
+    with _lock:
+        if _activo is None:
+            nombre = str(leer_ajuste("almacenamiento", "sheets")).strip().lower()
+            if nombre not in BACKENDS:
+                raise ValueError(f"Almacenamiento desconocido: {nombre}. Opciones: {', '.join(BACKENDS)}")
+            modulo = importlib.import_module(BACKENDS[nombre])
+            faltan = [f for f in INTERFAZ if not callable(getattr(modulo, f, None))]
+            if faltan:
+                raise RuntimeError(f"El backend {nombre} no implementa: {', '.join(faltan)}")
+            _activo = modulo
+    return _activo
+
+def compactar_registros(registros):
+    """
+    Un registro por fecha, ordenados por fecha: gana el de 'actualizado' más
+    reciente (a igualdad, el último) y conserva el 'creado' más antiguo.
+    Lo usan los backends en compactar_historial.
+    """
+    por_fecha = {}
+    for r in registros:
+        previo = por_fecha.get(r["fecha"])
+        if previo is None:
+            por_fecha[r["fecha"]] = dict(r)
+            continue
+        creados = [c for c in (previo["creado"], r["creado"]) if c]
+        ganador = dict(r) if r["actualizado"] >= previo["actualizado"] else previo
+        ganador["creado"] = min(creados) if creados else ""
+        por_fecha[r["fecha"]] = ganador
+    return [por_fecha[f] for f in sorted(por_fecha)]
@@ -0,0 +1,135 @@
+"""
+Planificador de peticiones a Google Sheets.
+
+Todas las peticiones HTTP del cliente gspread pasan por aquí (ver
+HTTPClientPlanificado). Se aplica un presupuesto de peticiones por minuto con
+un token bucket, las interactivas tienen turno antes que las de segundo plano,
+y los 429/5xx y errores de red se reintentan con espera exponencial con jitter.
+Los contadores de colas, esperas y limitaciones se consultan con metricas().
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import gspread
+import requests
+from gspread.http_client import HTTPClient
+
+from almacenamiento import leer_ajuste
+
+INTERACTIVA = 0
+FONDO = 1
+
+# La cuota de Sheets es de 60 lecturas/escrituras por minuto y usuario de servicio
+PETICIONES_POR_MINUTO = float(leer_ajuste("sheets_peticiones_minuto", 55))
+RAFAGA = int(leer_ajuste("sheets_rafaga", 10))
+MAX_REINTENTOS = int(leer_ajuste("sheets_reintentos", 5))
+ESPERA_BASE = 1.0
+ESPERA_MAX = 32.0
+CODIGOS_REINTENTABLES = {408, 429, 500, 502, 503, 504}
+
+_cond = threading.Condition()
+_bucket = {"tokens": float(RAFAGA), "relleno": time.monotonic()}
+_turnos = []  # heap de (prioridad, orden de llegada)
+_orden = itertools.count()
+_local = threading.local()
+_metricas = {
+    "peticiones": 0,
+    "reintentos": 0,
+    "limitadas_429": 0,
+    "esperas_cuota": 0,
+    "fallidas": 0,
+    "segundos_espera": 0.0,
+}
+
+@contextmanager
+def prioridad(nivel):
+    """Las peticiones hechas dentro del bloque usan esta prioridad (p. ej. FONDO)."""
+    previa = prioridad_actual()
+    _local.prioridad = nivel
+    try: yield
+    finally: _local.prioridad = previa
+
+def prioridad_actual():
+    """Prioridad del hilo actual, para heredarla en hilos auxiliares."""
+    return getattr(_local, "prioridad", INTERACTIVA)
+
+def _rellenar():
+    ahora = time.monotonic()
+    b = _bucket
+    b["tokens"] = min(RAFAGA, b["tokens"] + (ahora - b["relleno"]) * PETICIONES_POR_MINUTO / 60)
+    b["relleno"] = ahora
+
+def _esperar_turno(nivel):
+    turno = (nivel, next(_orden))
+    inicio = time.monotonic()
+    with _cond:
+        heapq.heappush(_turnos, turno)
+        espero_cuota = False
+        while True:
+            _rellenar()
+            if _turnos[0] != turno:
+                _cond.wait()
+            elif _bucket["tokens"] >= 1:
+                break
+            else:
+                espero_cuota = True
+                _cond.wait(timeout=(1 - _bucket["tokens"]) * 60 / PETICIONES_POR_MINUTO)
+        heapq.heappop(_turnos)
+        _bucket["tokens"] -= 1
+        if espero_cuota: _metricas["esperas_cuota"] += 1
+        _metricas["segundos_espera"] += time.monotonic() - inicio
+        _cond.notify_all()
+
+def ejecutar(funcion, *args, idempotente=True, **kwargs):
+    """
+    Lanza la petición con turno y cuota. Una petición no idempotente (añadir
+    filas) solo se reintenta tras un 429, que Sheets rechaza sin aplicar: tras
+    un 5xx o un corte de red no sabemos si llegó a escribirse.
+    """
+    nivel = prioridad_actual()
+    for intento in range(MAX_REINTENTOS + 1):
+        _esperar_turno(nivel)
+        try:
+            resultado = funcion(*args, **kwargs)
+            with _cond: _metricas["peticiones"] += 1
+            return resultado
+        except gspread.exceptions.APIError as e:
+            reintentable = e.code in CODIGOS_REINTENTABLES if idempotente else e.code == 429
+            if not reintentable or intento == MAX_REINTENTOS:
+                with _cond: _metricas["fallidas"] += 1
+                raise
+            if e.code == 429:
+                # Nos pasamos de cuota: vaciamos el bucket para frenar a todos
+                with _cond:
+                    _metricas["limitadas_429"] += 1
+                    _bucket["tokens"] = min(_bucket["tokens"], 0.0)
+                print(f"⚠️ Cuota de Sheets excedida, reintento {intento + 1}/{MAX_REINTENTOS}")
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if not idempotente or intento == MAX_REINTENTOS:
+                with _cond: _metricas["fallidas"] += 1
+                raise
+
+        with _cond: _metricas["reintentos"] += 1
+        espera = min(ESPERA_MAX, ESPERA_BASE * 2 ** intento)
+        time.sleep(espera / 2 + random.uniform(0, espera / 2))
+
+def metricas():
+    with _cond:
+        _rellenar()
+        return {
+            **_metricas,
+            "en_cola": len(_turnos),
+            "en_cola_fondo": sum(1 for t in _turnos if t[0] == FONDO),
+            "tokens": round(_bucket["tokens"], 2),
+        }
+
+class HTTPClientPlanificado(HTTPClient):
+    """HTTPClient de gspread que pasa cada petición por el planificador."""
+    def request(self, method, endpoint, *args, **kwargs):
+        # values:append no es idempotente: repetirlo duplicaría las filas
+        return ejecutar(super().request, method, endpoint, *args,
+                        idempotente=":append" not in endpoint, **kwargs)
@@ -0,0 +1,749 @@
+"""
+Backend de Google Sheets: una pestaña Usuarios, y por usuario Config_<usuario>
+(clave/valor), Taller_<usuario> (registro de eventos) e Historial_<usuario>#AAAA-MM
+(una fila por día, una pestaña por mes).
+"""
+import streamlit as st
+import gspread
+import bisect
+import re
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from google.auth.transport.requests import Request as GoogleAuthRequest
+
+from almacenamiento import compactar_registros, SEPARADOR_PARTICION
+from almacenamiento.planificador import HTTPClientPlanificado, prioridad, prioridad_actual
+
+NOMBRE_HOJA = "DB_GestorFlota"
+
+# --- CONEXIÓN ---
+# Un solo cliente por proceso, compartido por todas las sesiones e hilos.
+# La autenticación y el gc.open() se pagan una vez; después solo se renueva el
+# token cuando caduca y se verifica la conexión si lleva un rato sin usarse.
+SEGUNDOS_CHEQUEO_SALUD = 300
+
+_pool_lock = threading.RLock()
+_conexion_lock = threading.Lock()
+_pool = {"gc": None, "sh": None, "ultimo_uso": 0.0, "intentos": 0}
+
+def _crear_cliente():
+    if "gcp_service_account" in st.secrets:
+        creds_dict = dict(st.secrets["gcp_service_account"])
+        return gspread.service_account_from_dict(creds_dict, http_client=HTTPClientPlanificado)
+    return gspread.service_account("datos_sistema.json", http_client=HTTPClientPlanificado)
+
+def _refrescar_token(gc):
+    creds = getattr(getattr(gc, "http_client", None), "auth", None) or getattr(gc, "auth", None)
+    if creds is not None and not creds.valid:
+        creds.refresh(GoogleAuthRequest())
+
+def _conexion_sana(sh):
+    try:
+        sh.fetch_sheet_metadata(params={"fields": "spreadsheetId"})
+        return True
+    except Exception as e:
+        print(f"Conexión no responde, reconectando: {e}")
+        return False
+
+def reiniciar_conexion():
+    """Descarta el cliente compartido; la próxima llamada vuelve a autenticar."""
+    with _pool_lock:
+        _pool.update(gc=None, sh=None, ultimo_uso=0.0)
+        invalidar_catalogo()
+
+def registrar_fallo(e):
+    """Si el error es de red o de credenciales, fuerza una reconexión."""
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        reiniciar_conexion()
+    elif isinstance(e, gspread.exceptions.APIError) and e.code == 401:
+        reiniciar_conexion()
+    elif isinstance(e, gspread.exceptions.APIError) and e.code == 400:
+        # Suele ser un rango sobre una pestaña que ya no existe
+        invalidar_catalogo()
+
+def conectar_google_sheets():
+    # Las peticiones de red van fuera del candado: un Sheets lento no debe
+    # bloquear a los hilos que solo consultan el catálogo o los índices
+    with _pool_lock:
+        ahora = time.monotonic()
+        gc, sh, intento = _pool["gc"], _pool["sh"], _pool["intentos"]
+        chequear = sh is not None and ahora - _pool["ultimo_uso"] > SEGUNDOS_CHEQUEO_SALUD
+        # Marcamos el uso ya, para que solo un hilo haga el chequeo de salud
+        if sh is not None: _pool["ultimo_uso"] = ahora
+
+    if sh is not None:
+        try:
+            _refrescar_token(gc)
+        except Exception as e:
+            print(f"Error renovando token: {e}")
+            sh = None
+        if sh is not None and chequear and not _conexion_sana(sh): sh = None
+        if sh is not None: return sh
+
+    # Una sola reconexión a la vez: los hilos que llegan mientras tanto esperan
+    # y se quedan con el resultado de ese intento, sea la hoja o el fallo
+    with _conexion_lock:
+        with _pool_lock:
+            if _pool["intentos"] != intento: return _pool["sh"]
+        try:
+            gc = _crear_cliente()
+            sh = gc.open(NOMBRE_HOJA)
+        except Exception as e:
+            print(f"Error de conexión: {e}")
+            with _pool_lock:
+                reiniciar_conexion()
+                _pool["intentos"] += 1
+            return None
+        with _pool_lock:
+            _pool.update(gc=gc, sh=sh, ultimo_uso=time.monotonic(), intentos=_pool["intentos"] + 1)
+            # Hoja nueva: las pestañas del catálogo y lo que sabemos de sus filas
+            # son de la conexión anterior
+            invalidar_catalogo()
+            _indices.clear()
+            _fechas_ordenadas.clear()
+            _filas_config.clear()
+        return sh
+
+# --- CATÁLOGO DE PESTAÑAS ---
+# Pestañas (con su id) y encabezados conocidos, cargados con una sola llamada
+# a sh.worksheets(). Solo se invalida al crear o migrar una pestaña, o al
+# reconectar, de modo que resolver Config_/Historial_ no cuesta peticiones.
+_catalogo = {"pestanas": None, "encabezados": {}, "cargado": 0.0}
+
+def invalidar_catalogo():
+    with _pool_lock:
+        _catalogo["pestanas"] = None
+        _catalogo["encabezados"] = {}
+
+def _pestanas(sh):
+    with _pool_lock:
+        if _catalogo["pestanas"] is not None: return _catalogo["pestanas"]
+    pestanas = {ws.title: ws for ws in sh.worksheets()}
+    with _pool_lock:
+        # Si otro hilo lo cargó mientras tanto, nos quedamos con el suyo
+        if _catalogo["pestanas"] is None:
+            _catalogo["pestanas"] = pestanas
+            _catalogo["cargado"] = time.monotonic()
+        return _catalogo["pestanas"]
+
+def obtener_pestana(sh, nombre):
+    """Como sh.worksheet() pero desde el catálogo en memoria."""
+    ws = _pestanas(sh).get(nombre)
+    if ws is None: raise gspread.exceptions.WorksheetNotFound(nombre)
+    return ws
+
+def asegurar_pestana(sh, nombre):
+    ws = _pestanas(sh).get(nombre)
+    if ws is not None: return ws
+    try:
+        ws = sh.add_worksheet(nombre, 100, 20)
+    except gspread.exceptions.APIError:
+        # Otro proceso la creó después de cargar el catálogo
+        ws = sh.worksheet(nombre)
+    with _pool_lock:
+        _pestanas(sh)[nombre] = ws
+        _catalogo["encabezados"].pop(nombre, None)
+    return ws
+
+def obtener_encabezados(ws):
+    with _pool_lock:
+        cache = _catalogo["encabezados"].get(ws.title)
+    if cache is not None: return cache
+    fila = ws.row_values(1)
+    fijar_encabezados(ws, fila)
+    return fila
+
+def fijar_encabezados(ws, encabezados):
+    with _pool_lock:
+        _catalogo["encabezados"][ws.title] = list(encabezados)
+
+# --- ÍNDICE DE FECHAS (HISTORIAL) ---
+# Por pestaña: fecha -> filas donde aparece. Se construye leyendo solo la
+# columna Fecha y se mantiene al añadir filas, así un día concreto se lee con
+# un rango exacto en vez de descargar todo el historial. Las fechas se guardan
+# además ordenadas, para resolver un rango de días con dos búsquedas binarias.
+COLUMNAS_HISTORIAL = ["Fecha", "Usuario", "JSON", "Creado", "Actualizado"]
+# Con más tramos que estos se lee de la primera a la última fila de una vez
+MAX_TRAMOS_RANGO = 50
+
+_indices = {}
+_fechas_ordenadas = {}
+
+def invalidar_indice(nombre_pestana):
+    with _pool_lock:
+        _indices.pop(nombre_pestana, None)
+        _fechas_ordenadas.pop(nombre_pestana, None)
+
+def invalidar_usuario(usuario):
+    """
+    Olvida lo que sabemos de las pestañas del usuario: alguien escribió desde
+    fuera. También el catálogo, porque compactar o archivar en otro servidor
+    crea y borra meses; con el viejo leeríamos pestañas borradas y no veríamos
+    las nuevas.
+    """
+    with _pool_lock:
+        for nombre in [n for n in _indices if _es_historial_de(usuario, n)]:
+            invalidar_indice(nombre)
+        invalidar_catalogo()
+
+def _indice_fechas(ws):
+    with _pool_lock:
+        idx = _indices.get(ws.title)
+    if idx is not None: return idx
+    
+    return _guardar_indice(ws, ws.col_values(1))
+
+def _guardar_indice(ws, columna):
+    """Construye el índice desde la columna Fecha completa (con encabezado)."""
+    idx = {}
+    for n, valor in enumerate(columna[1:], start=2):
+        valor = str(valor).strip()
+        if valor: idx.setdefault(valor, []).append(n)
+    with _pool_lock:
+        _indices[ws.title] = idx
+        _fechas_ordenadas[ws.title] = sorted(idx)
+    return idx
+
+def _filas_rango(ws, desde_str, hasta_str):
+    """[(fila, fecha)] de los días entre desde y hasta, por orden de fila, según el índice."""
+    _indice_fechas(ws)
+    with _pool_lock:
+        idx, fechas = _indices.get(ws.title, {}), _fechas_ordenadas.get(ws.title, [])
+        a = bisect.bisect_left(fechas, desde_str)
+        b = bisect.bisect_right(fechas, hasta_str)
+        return sorted((n, f) for f in fechas[a:b] for n in idx[f])
+
+def _indexar_fila_agregada(ws, fecha_str, respuesta):
+    """Apunta en el índice la fila que devolvió append_row."""
+    try:
+        rango = respuesta["updates"]["updatedRange"]
+        fila = int(re.search(r"![A-Z]+(\d+)", rango).group(1))
+    except Exception:
+        invalidar_indice(ws.title)
+        return
+    with _pool_lock:
+        idx = _indices.get(ws.title)
+        if idx is None: return
+        if fecha_str not in idx: bisect.insort(_fechas_ordenadas[ws.title], fecha_str)
+        idx.setdefault(fecha_str, []).append(fila)
+
+# Campos del registro en el orden de las columnas de la pestaña
+CAMPOS_HISTORIAL = ("fecha", "usuario", "json", "creado", "actualizado")
+_LETRAS = "ABCDE"
+
+def _tramos(columnas):
+    """
+    Columnas a leer como tramos contiguos [(ini, fin)]. La fecha va siempre,
+    hace falta para verificar la fila. None = todas.
+    """
+    if columnas is None: return [(0, len(CAMPOS_HISTORIAL) - 1)]
+    indices = sorted({0} | {CAMPOS_HISTORIAL.index(c) for c in columnas})
+    tramos = []
+    for i in indices:
+        if tramos and tramos[-1][1] == i - 1: tramos[-1] = (tramos[-1][0], i)
+        else: tramos.append((i, i))
+    return tramos
+
+def _unir_tramos(tramos, trozos):
+    """Recompone una fila completa (vacía en lo no leído) desde sus tramos."""
+    fila = [""] * len(CAMPOS_HISTORIAL)
+    for (ini, _), valores in zip(tramos, trozos):
+        for k, v in enumerate(valores): fila[ini + k] = v
+    return fila
+
+def _leer_filas_fecha(ws, fecha_str, columnas=None):
+    """Filas de una fecha, en orden de hoja, con un solo batch_get (solo las columnas pedidas)."""
+    tramos = _tramos(columnas)
+    for _ in range(2):
+        filas = _indice_fechas(ws).get(fecha_str, [])
+        if not filas: return []
+        bloques = ws.batch_get([f"{_LETRAS[a]}{n}:{_LETRAS[b]}{n}" for n in filas for a, b in tramos])
+        trozos = [b[0] if b else [] for b in bloques]
+        resultado = [_unir_tramos(tramos, trozos[i:i + len(tramos)]) for i in range(0, len(trozos), len(tramos))]
+        if all(r and str(r[0]).strip() == fecha_str for r in resultado):
+            return resultado
+        # La hoja cambió por fuera: reconstruimos el índice y reintentamos
+        invalidar_indice(ws.title)
+    return []
+
+def _pestana_config(usuario):
+    return f"Config_{usuario.strip().lower()}"
+
+def _pestana_historial(usuario, mes=None):
+    """Historial_<usuario>#AAAA-MM del mes 'AAAA-MM'; sin mes, la pestaña única antigua."""
+    nombre = f"Historial_{usuario.strip().lower()}"
+    return f"{nombre}{SEPARADOR_PARTICION}{mes}" if mes else nombre
+
+def _mes_de_pestana(usuario, nombre):
+    """'AAAA-MM' si nombre es una partición mensual del usuario; si no, None."""
+    prefijo = _pestana_historial(usuario) + SEPARADOR_PARTICION
+    mes = nombre[len(prefijo):] if nombre.startswith(prefijo) else ""
+    return mes if re.fullmatch(r"\d{4}-\d{2}", mes) else None
+
+def _es_historial_de(usuario, nombre):
+    return nombre == _pestana_historial(usuario) or _mes_de_pestana(usuario, nombre) is not None
+
+def _pestana_taller(usuario):
+    return f"Taller_{usuario.strip().lower()}"
+
+def _fila_a_registro(fila, columnas=None):
+    fila = list(fila) + [""] * (len(COLUMNAS_HISTORIAL) - len(fila))
+    registro = {
+        "fecha": str(fila[0]).strip(),
+        "usuario": fila[1],
+        "json": fila[2] or "[]",
+        "creado": fila[3],
+        "actualizado": fila[4]
+    }
+    if columnas is None: return registro
+    return {c: registro[c] for c in CAMPOS_HISTORIAL if c == "fecha" or c in columnas}
+
+def _hoja():
+    sh = conectar_google_sheets()
+    if not sh: raise ConnectionError("Sin conexión con Google Sheets.")
+    return sh
+
+# --- USUARIOS ---
+def buscar_usuario(usuario):
+    ws = obtener_pestana(_hoja(), "Usuarios")
+    u_target = usuario.strip().lower()
+    for fila in ws.get_all_values()[1:]:
+        if fila and str(fila[0]).strip().lower() == u_target:
+            return {
+                "usuario": u_target,
+                "password": str(fila[1]) if len(fila) > 1 else "",
+                "totp": str(fila[2]) if len(fila) > 2 else ""
+            }
+    return None
+
+def crear_usuario(usuario, pass_hash, totp_secret):
+    ws = obtener_pestana(_hoja(), "Usuarios")
+    ws.append_row([usuario, pass_hash, totp_secret])
+    return True
+
+def cambiar_password(usuario, pass_hash):
+    ws = obtener_pestana(_hoja(), "Usuarios")
+    u_target = usuario.strip().lower()
+    for i, fila in enumerate(ws.col_values(1)):
+        if i > 0 and str(fila).strip().lower() == u_target:
+            ws.update_cell(i + 1, 2, pass_hash)
+            return True
+    return False
+
+# --- CONFIGURACIÓN ---
+# Fila de cada clave en Config_<usuario>, para actualizar celdas sueltas
+_filas_config = {}
+
+def _recordar_filas_config(ws, claves):
+    with _pool_lock:
+        _filas_config[ws.title] = {str(c).strip(): n for n, c in enumerate(claves, start=1) if str(c).strip()}
+
+def leer_config(usuario):
+    ws = asegurar_pestana(_hoja(), _pestana_config(usuario))
+    return _config_desde_filas(ws, ws.get_all_values())
+
+def _config_desde_filas(ws, filas):
+    _recordar_filas_config(ws, [f[0] if f else "" for f in filas])
+    config_dict = {}
+    for fila in filas:
+        if len(fila) >= 2:
+            config_dict[str(fila[0]).strip()] = str(fila[1]).strip()
+    return config_dict
+
+def leer_config_clave(usuario, clave):
+    """Valor de una sola clave: lee una celda si ya sabemos en qué fila está."""
+    ws = asegurar_pestana(_hoja(), _pestana_config(usuario))
+    with _pool_lock:
+        n = _filas_config.get(ws.title, {}).get(clave)
+    if n is None:
+        return leer_config(usuario).get(clave)
+    valores = ws.get(f"A{n}:B{n}")
+    fila = valores[0] if valores else []
+    if len(fila) >= 1 and str(fila[0]).strip() == clave:
+        return str(fila[1]).strip() if len(fila) > 1 else ""
+    # La clave cambió de fila: releemos la config completa
+    return leer_config(usuario).get(clave)
+
+def escribir_config(usuario, filas):
+    ws = asegurar_pestana(_hoja(), _pestana_config(usuario))
+    try:
+        ws.clear()
+        ws.update(range_name="A1", values=filas)
+        _recordar_filas_config(ws, [f[0] for f in filas])
+    except Exception:
+        with _pool_lock: _filas_config.pop(ws.title, None)
+        raise
+    return True
+
+def actualizar_config(usuario, cambios):
+    """
+    Actualiza solo las celdas de valor de las claves dadas, en una escritura.
+    Las filas se sacan de la columna de claves recién leída, no de la memoria:
+    si otro servidor o una edición a mano movió las filas, escribir por una
+    posición vieja pisaría el valor de otra clave.
+    """
+    ws = asegurar_pestana(_hoja(), _pestana_config(usuario))
+    _recordar_filas_config(ws, ws.col_values(1))
+    with _pool_lock: posiciones = dict(_filas_config[ws.title])
+    
+    siguiente = max(posiciones.values(), default=0) + 1
+    datos, nuevas = [], {}
+    for clave, valor in cambios.items():
+        n = posiciones.get(clave)
+        if n is None:
+            n = nuevas[clave] = siguiente
+            siguiente += 1
+            datos.append({"range": f"A{n}:B{n}", "values": [[clave, valor]]})
+        else:
+            datos.append({"range": f"B{n}", "values": [[valor]]})
+    ws.batch_update(datos)
+    
+    with _pool_lock:
+        _filas_config.setdefault(ws.title, {}).update(nuevas)
+    return True
+
+# --- HISTORIAL ---
+def _asegurar_encabezados(ws):
+    primera_fila = obtener_encabezados(ws)
+    if not primera_fila:
+        ws.append_row(COLUMNAS_HISTORIAL)
+        fijar_encabezados(ws, COLUMNAS_HISTORIAL)
+    elif len(primera_fila) < 5 and "Creado" not in primera_fila:
+        ws.update(range_name="D1:E1", values=[["Creado", "Actualizado"]])
+        fijar_encabezados(ws, primera_fila[:3] + ["Creado", "Actualizado"])
+
+# --- PARTICIONES MENSUALES ---
+# Cada mes va en su pestaña (Historial_<usuario>#AAAA-MM): las escrituras se
+# dirigen por fecha y un rango solo lee los meses que toca, en paralelo. La
+# pestaña única antigua, si existe, se trata como una partición más que puede
+# tener cualquier fecha: se lee y se actualiza, pero ya no crece.
+MAX_LECTURAS_PARALELAS = 6
+# Antigüedad del catálogo a partir de la cual se recarga si falta algún mes
+# (puede haberlo creado otro servidor)
+SEGUNDOS_REFRESCO_CATALOGO = 60
+
+def _meses_entre(desde_str, hasta_str):
+    """['AAAA-MM', ...] de desde a hasta, ambos incluidos."""
+    a, m = int(desde_str[:4]), int(desde_str[5:7])
+    fin = (int(hasta_str[:4]), int(hasta_str[5:7]))
+    meses = []
+    while (a, m) <= fin:
+        meses.append(f"{a:04d}-{m:02d}")
+        a, m = (a + 1, 1) if m == 12 else (a, m + 1)
+    return meses
+
+def _particiones(sh, usuario, desde_str, hasta_str):
+    """Pestañas existentes que pueden tener días del rango: la antigua primero, luego los meses."""
+    nombres = [_pestana_historial(usuario)] + [_pestana_historial(usuario, m) for m in _meses_entre(desde_str, hasta_str)]
+    pestanas = _pestanas(sh)
+    if any(n not in pestanas for n in nombres[1:]):
+        with _pool_lock:
+            viejo = time.monotonic() - _catalogo["cargado"] > SEGUNDOS_REFRESCO_CATALOGO
+        if viejo:
+            invalidar_catalogo()
+            pestanas = _pestanas(sh)
+    return [pestanas[n] for n in nombres if n in pestanas]
+
+def _particion_escritura(sh, fecha_str, usuario):
+    ws = asegurar_pestana(sh, _pestana_historial(usuario, fecha_str[:7]))
+    _asegurar_encabezados(ws)
+    return ws
+
+def _en_paralelo(funcion, pestanas):
+    """funcion(ws) para cada pestaña, en hilos si hay varias; resultados en el mismo orden."""
+    if len(pestanas) <= 1: return [funcion(ws) for ws in pestanas]
+    nivel = prioridad_actual()
+    def tarea(ws):
+        with prioridad(nivel): return funcion(ws)
+    with ThreadPoolExecutor(max_workers=min(MAX_LECTURAS_PARALELAS, len(pestanas))) as ex:
+        return list(ex.map(tarea, pestanas))
+
+def leer_historial_dia(usuario, fecha_str, columnas=None):
+    pestanas = _particiones(_hoja(), usuario, fecha_str, fecha_str)
+    filas = _en_paralelo(lambda ws: _leer_filas_fecha(ws, fecha_str, columnas), pestanas)
+    return [_fila_a_registro(f, columnas) for trozo in filas for f in trozo]
+
+def _bloques_contiguos(filas):
+    """[2, 3, 4, 9, 10] -> [(2, 4), (9, 10)]"""
+    bloques = []
+    for n in filas:
+        if bloques and bloques[-1][1] == n - 1: bloques[-1] = (bloques[-1][0], n)
+        else: bloques.append((n, n))
+    return bloques
+
+def _leer_rango_pestana(ws, desde_str, hasta_str, columnas):
+    """
+    Filas de los días entre desde y hasta de una pestaña. Salen del índice de
+    fechas y se leen solo esos bloques (y columnas) en un batch_get; con la
+    hoja ordenada por fecha es un único bloque.
+    """
+    tramos = _tramos(columnas)
+    for _ in range(2):
+        esperadas = _filas_rango(ws, desde_str, hasta_str)
+        if not esperadas: return []
+        filas = [n for n, _ in esperadas]
+        bloques = _bloques_contiguos(filas)
+        if len(bloques) > MAX_TRAMOS_RANGO: bloques = [(filas[0], filas[-1])]
+        
+        trozos = ws.batch_get([f"{_LETRAS[a]}{ini}:{_LETRAS[b]}{fin}" for ini, fin in bloques for a, b in tramos])
+        leidas = {}
+        for i, (ini, fin) in enumerate(bloques):
+            cols = trozos[i * len(tramos):(i + 1) * len(tramos)]
+            for k in range(fin - ini + 1):
+                leidas[ini + k] = _unir_tramos(tramos, [c[k] if k < len(c) else [] for c in cols])
+        
+        resultado = [leidas[n] for n in filas]
+        if all(str(f[0]).strip() == fecha for f, (_, fecha) in zip(resultado, esperadas)):
+            return resultado
+        # La hoja cambió por fuera: reconstruimos el índice y reintentamos
+        invalidar_indice(ws.title)
+    return []
+
+def leer_historial_rango(usuario, desde_str, hasta_str, columnas=None):
+    """Días entre desde y hasta, leyendo en paralelo solo los meses que se solapan."""
+    pestanas = _particiones(_hoja(), usuario, desde_str, hasta_str)
+    filas = _en_paralelo(lambda ws: _leer_rango_pestana(ws, desde_str, hasta_str, columnas), pestanas)
+    return [_fila_a_registro(f, columnas) for trozo in filas for f in trozo]
+
+def agregar_historial(usuario, registro):
+    r = registro
+    ws = _particion_escritura(_hoja(), r["fecha"], usuario)
+    resp = ws.append_row([r["fecha"], r["usuario"], r["json"], r["creado"], r["actualizado"]])
+    _indexar_fila_agregada(ws, r["fecha"], resp)
+    return True
+
+def upsert_historial(usuario, registro):
+    """
+    Escribe el día en su fila existente (conservando 'Creado') o lo añade al
+    final de su mes. Una lectura exacta y una escritura, sin tocar el resto.
+    """
+    r = registro
+    pestanas = _particiones(_hoja(), usuario, r["fecha"], r["fecha"])
+    with _pool_lock:
+        ya_indexadas = [ws for ws in pestanas if ws.title in _indices]
+    for intento in range(2):
+        # Primero el mes; la pestaña antigua solo si el día sigue allí
+        for ws in reversed(pestanas):
+            filas = _leer_filas_fecha(ws, r["fecha"], ("creado",))
+            if not filas: continue
+            
+            creado = (filas[0][3] if len(filas[0]) > 3 else "") or r["creado"]
+            # Si hubiera duplicados del mismo día los dejamos todos iguales
+            cambios = [
+                {"range": f"A{n}:E{n}", "values": [[r["fecha"], r["usuario"], r["json"], creado, r["actualizado"]]]}
+                for n in _indice_fechas(ws).get(r["fecha"], [])
+            ]
+            ws.batch_update(cambios)
+            return True
+        # Antes de añadir, la columna Fecha otra vez: un índice de hace rato no
+        # ve los días escritos desde otro servidor o a mano
+        if intento or not ya_indexadas: break
+        for ws in ya_indexadas: invalidar_indice(ws.title)
+    return agregar_historial(usuario, r)
+
+def eliminar_historial(usuario, fecha_str):
+    """Reescribe sin ese día solo las pestañas que lo tienen (normalmente, un mes)."""
+    for ws in _particiones(_hoja(), usuario, fecha_str, fecha_str):
+        if fecha_str not in _indice_fechas(ws): continue
+        try:
+            rows = ws.get_all_values()
+            if not rows: continue
+            
+            filtrados = [r for r in rows[1:] if not (len(r) > 0 and str(r[0]).strip() == fecha_str)]
+            ws.clear()
+            ws.update(range_name="A1", values=[rows[0]] + filtrados)
+        finally:
+            invalidar_indice(ws.title)
+    return True
+
+def _particiones_anteriores(sh, usuario, fecha_str):
+    """Pestañas que pueden tener días anteriores a fecha_str: la antigua y los meses hasta el suyo."""
+    base = _pestana_historial(usuario)
+    pestanas = _pestanas(sh)
+    meses = {n: _mes_de_pestana(usuario, n) for n in pestanas}
+    meses = sorted(n for n, mes in meses.items() if mes is not None and mes <= fecha_str[:7])
+    return [pestanas[n] for n in [base] + meses if n in pestanas]
+
+def leer_historial_anterior(usuario, fecha_str):
+    """Todos los días anteriores a fecha_str (para archivarlos)."""
+    registros = []
+    for ws in _particiones_anteriores(_hoja(), usuario, fecha_str):
+        registros += [
+            _fila_a_registro(f) for f in ws.get_all_values()[1:]
+            if f and str(f[0]).strip() and str(f[0]).strip() < fecha_str
+        ]
+    return registros
+
+def eliminar_historial_anterior(usuario, archivados):
+    """
+    Quita los días ya archivados, [(fecha, actualizado)]: solo las filas que
+    siguen igual que cuando se leyeron. Un día editado entre medias se queda
+    (el siguiente archivado lo recoge). Un mes que se queda vacío se borra
+    como pestaña.
+    """
+    archivados = set(archivados)
+    if not archivados: return True
+    def archivada(fila):
+        r = _fila_a_registro(fila)
+        return (r["fecha"], r["actualizado"]) in archivados
+    
+    sh = _hoja()
+    for ws in _particiones_anteriores(sh, usuario, max(f for f, _ in archivados)):
+        try:
+            rows = ws.get_all_values()
+            quedan = [r for r in rows[1:] if not archivada(r)]
+            if len(quedan) == len(rows) - 1: continue
+            
+            if _mes_de_pestana(usuario, ws.title) and not any(str(c).strip() for r in quedan for c in r):
+                sh.del_worksheet(ws)
+                with _pool_lock:
+                    if _catalogo["pestanas"] is not None: _catalogo["pestanas"].pop(ws.title, None)
+            else:
+                _reescribir_pestana(ws, quedan, len(rows) - 1)
+        finally:
+            invalidar_indice(ws.title)
+    return True
+
+def _tamano(filas):
+    return sum(len(str(c).encode("utf-8")) for f in filas for c in f)
+
+def _reescribir_pestana(ws, filas, filas_previas):
+    """
+    Sustituye los datos de la pestaña escribiendo encima y limpiando después
+    solo las filas sobrantes. Si algo falla a medias quedan filas de más (días
+    repetidos que la próxima compactación junta), nunca una pestaña vacía.
+    """
+    # Filas a ancho completo, para no dejar celdas de la fila que había debajo
+    ancho = len(COLUMNAS_HISTORIAL)
+    ws.update(range_name="A1", values=[COLUMNAS_HISTORIAL] + [list(f) + [""] * (ancho - len(f)) for f in filas])
+    if filas_previas > len(filas):
+        ws.batch_clear([f"{len(filas) + 2}:{filas_previas + 1}"])
+    fijar_encabezados(ws, COLUMNAS_HISTORIAL)
+
+def compactar_historial(usuario):
+    """
+    Deja cada mes con una fila por día, ordenado por fecha, y vacía la pestaña
+    antigua repartiendo sus días en los meses (se borra si queda vacía).
+    Solo se reescriben las pestañas que cambian.
+    """
+    sh = _hoja()
+    base = _pestana_historial(usuario)
+    por_mes, originales, invalidas, ocupadas = {}, {}, [], {}
+    antes = {"filas": 0, "bytes": 0}
+    # La antigua va primero: a igualdad de 'actualizado' ganan las filas de los meses
+    pestanas = _particiones_anteriores(sh, usuario, "9999-12-31")
+    for ws in pestanas:
+        valores = ws.get_all_values()
+        ocupadas[ws.title] = max(len(valores) - 1, 0)
+        datos = [f for f in valores[1:] if any(str(c).strip() for c in f)]
+        antes["filas"] += len(datos)
+        antes["bytes"] += _tamano(datos)
+        if ws.title == base:
+            for f in datos:
+                fecha = str(f[0]).strip()
+                if re.fullmatch(r"\d{4}-\d{2}-\d{2}", fecha): por_mes.setdefault(fecha[:7], []).append(f)
+                else: invalidas.append(f)  # no se sabe a qué mes van: se quedan donde están
+        else:
+            mes = _mes_de_pestana(usuario, ws.title)
+            originales[mes] = datos
+            por_mes.setdefault(mes, []).extend(datos)
+    
+    despues = {"filas": len(invalidas), "bytes": _tamano(invalidas)}
+    for mes, filas in sorted(por_mes.items()):
+        registros = compactar_registros([_fila_a_registro(f) for f in filas])
+        nuevas = [[r["fecha"], r["usuario"], r["json"], r["creado"], r["actualizado"]] for r in registros]
+        despues["filas"] += len(nuevas)
+        despues["bytes"] += _tamano(nuevas)
+        if [list(f) + [""] * (5 - len(f)) for f in originales.get(mes, [])] == nuevas: continue
+        
+        ws = asegurar_pestana(sh, _pestana_historial(usuario, mes))
+        try:
+            _reescribir_pestana(ws, nuevas, ocupadas.get(ws.title, 0))
+        finally:
+            invalidar_indice(ws.title)
+    
+    ws_base = next((ws for ws in pestanas if ws.title == base), None)
+    if ws_base is not None:
+        try:
+            if invalidas:
+                _reescribir_pestana(ws_base, invalidas, ocupadas[base])
+            else:
+                sh.del_worksheet(ws_base)
+                with _pool_lock:
+                    if _catalogo["pestanas"] is not None: _catalogo["pestanas"].pop(base, None)
+        finally:
+            invalidar_indice(base)
+    return {
+        "filas_antes": antes["filas"], "filas_despues": despues["filas"],
+        "bytes_antes": antes["bytes"], "bytes_despues": despues["bytes"]
+    }
+
+# --- TALLER ---
+COLUMNAS_TALLER = ["Momento", "Unidad", "Estado", "Usuario"]
+
+def leer_eventos_taller(usuario, desde=0):
+    """Eventos a partir de la posición 'desde'; solo se descargan las filas nuevas."""
+    ws = asegurar_pestana(_hoja(), _pestana_taller(usuario))
+    return [_fila_a_evento(f) for f in ws.get(f"A{desde + 2}:D")]
+
+def _fila_a_evento(fila):
+    f = list(fila) + [""] * (len(COLUMNAS_TALLER) - len(fila))
+    try: unidad = int(f[1])
+    except ValueError: unidad = None  # fila inválida: cuenta para la posición pero no se aplica
+    return {"momento": f[0], "unidad": unidad, "estado": str(f[2]).strip(), "usuario": f[3]}
+
+def agregar_eventos_taller(usuario, eventos):
+    """Añade los eventos en una sola petición y devuelve la posición del primero."""
+    ws = asegurar_pestana(_hoja(), _pestana_taller(usuario))
+    filas = [[e["momento"], e["unidad"], e["estado"], e["usuario"]] for e in eventos]
+    con_encabezado = not obtener_encabezados(ws)
+    if con_encabezado: filas.insert(0, COLUMNAS_TALLER)
+    
+    resp = ws.append_rows(filas)
+    if con_encabezado: fijar_encabezados(ws, COLUMNAS_TALLER)
+    rango = resp["updates"]["updatedRange"]
+    primera = int(re.search(r"![A-Z]+(\d+)", rango).group(1)) + (1 if con_encabezado else 0)
+    return primera - 2
+
+# --- ARRANQUE ---
+def leer_inicio(usuario, fecha_str, desde_taller=0):
+    """
+    Todo lo que necesita la primera pantalla en un solo values_batch_get:
+    config, eventos nuevos del taller y las filas del día. Si una pestaña de
+    historial aún no tiene índice de fechas se pide su columna Fecha en el
+    mismo lote para construirlo y el día se lee aparte (solo si existe).
+    """
+    sh = _hoja()
+    ws_cfg = asegurar_pestana(sh, _pestana_config(usuario))
+    ws_tal = asegurar_pestana(sh, _pestana_taller(usuario))
+    rangos = [f"'{ws_cfg.title}'!A:B", f"'{ws_tal.title}'!A{desde_taller + 2}:D"]
+    
+    partes = []  # (pestaña, filas del día según el índice o None, primer bloque, nº de bloques)
+    for ws in _particiones(sh, usuario, fecha_str, fecha_str):
+        with _pool_lock:
+            idx = _indices.get(ws.title)
+        filas_dia = idx.get(fecha_str, []) if idx is not None else None
+        nuevos = [f"'{ws.title}'!A:A"] if filas_dia is None else [f"'{ws.title}'!A{n}:E{n}" for n in filas_dia]
+        partes.append((ws, filas_dia, len(rangos), len(nuevos)))
+        rangos += nuevos
+    bloques = [vr.get("values", []) for vr in sh.values_batch_get(rangos).get("valueRanges", [])]
+    bloques += [[]] * (len(rangos) - len(bloques))
+    
+    dia = []
+    for ws, filas_dia, ini, n in partes:
+        if filas_dia is None:
+            _guardar_indice(ws, [f[0] if f else "" for f in bloques[ini]])
+            dia += _leer_filas_fecha(ws, fecha_str)
+            continue
+        leidas = [b[0] if b else [] for b in bloques[ini:ini + n]]
+        if not all(f and str(f[0]).strip() == fecha_str for f in leidas):
+            invalidar_indice(ws.title)
+            leidas = _leer_filas_fecha(ws, fecha_str)
+        dia += leidas
+    return {
+        "config": _config_desde_filas(ws_cfg, bloques[0]),
+        "eventos_taller": [_fila_a_evento(f) for f in bloques[1]],
+        "historial": [_fila_a_registro(f) for f in dia]
+    }
@@ -0,0 +1,253 @@
+"""
+Backend local en SQLite. Mismo modelo que la hoja de cálculo (usuarios, config
+clave/valor e historial por día) pero con índices reales sobre (usuario, fecha),
+así que funciona sin conexión y cada consulta cuesta microsegundos.
+"""
+import os
+import sqlite3
+import threading
+
+from almacenamiento import leer_ajuste
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUTA_DB = leer_ajuste("sqlite_ruta", os.path.join(BASE_DIR, "gestor_flota.db"))
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS usuarios (
+    usuario  TEXT PRIMARY KEY,
+    password TEXT NOT NULL,
+    totp     TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS config (
+    usuario TEXT NOT NULL,
+    clave   TEXT NOT NULL,
+    valor   TEXT NOT NULL DEFAULT '',
+    orden   INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (usuario, clave)
+);
+CREATE TABLE IF NOT EXISTS historial (
+    usuario     TEXT NOT NULL,
+    fecha       TEXT NOT NULL,
+    autor       TEXT NOT NULL DEFAULT '',
+    json        TEXT NOT NULL DEFAULT '[]',
+    creado      TEXT NOT NULL DEFAULT '',
+    actualizado TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (usuario, fecha)
+);
+CREATE TABLE IF NOT EXISTS taller_eventos (
+    id      INTEGER PRIMARY KEY AUTOINCREMENT,
+    usuario TEXT NOT NULL,
+    momento TEXT NOT NULL DEFAULT '',
+    unidad  INTEGER NOT NULL,
+    estado  TEXT NOT NULL,
+    autor   TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS idx_taller_usuario ON taller_eventos (usuario, id);
+"""
+
+# Una conexión por hilo (sqlite3 no comparte conexiones entre hilos)
+_local = threading.local()
+_init_lock = threading.Lock()
+_inicializada = False
+
+def _conexion():
+    global _inicializada
+    con = getattr(_local, "con", None)
+    if con is None:
+        con = sqlite3.connect(RUTA_DB, timeout=10)
+        con.row_factory = sqlite3.Row
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        with _init_lock:
+            if not _inicializada:
+                con.executescript(ESQUEMA)
+                _inicializada = True
+        _local.con = con
+    return con
+
+def registrar_fallo(e):
+    pass
+
+def invalidar_usuario(usuario):
+    pass
+
+# Campo del registro -> columna de la tabla historial
+COLUMNAS_HISTORIAL = {
+    "fecha": "fecha",
+    "usuario": "autor",
+    "json": "json",
+    "creado": "creado",
+    "actualizado": "actualizado"
+}
+
+def _select_historial(columnas):
+    """Columnas a seleccionar; la fecha siempre. None = todas."""
+    campos = [c for c in COLUMNAS_HISTORIAL if columnas is None or c == "fecha" or c in columnas]
+    return ", ".join(COLUMNAS_HISTORIAL[c] for c in campos)
+
+def _registro(row):
+    columnas = row.keys()
+    return {c: row[col] for c, col in COLUMNAS_HISTORIAL.items() if col in columnas}
+
+# --- USUARIOS ---
+def buscar_usuario(usuario):
+    row = _conexion().execute(
+        "SELECT usuario, password, totp FROM usuarios WHERE usuario = ?",
+        (usuario.strip().lower(),)
+    ).fetchone()
+    return dict(row) if row else None
+
+def crear_usuario(usuario, pass_hash, totp_secret):
+    with _conexion() as con:
+        con.execute("INSERT INTO usuarios (usuario, password, totp) VALUES (?, ?, ?)",
+                    (usuario, pass_hash, totp_secret))
+    return True
+
+def cambiar_password(usuario, pass_hash):
+    with _conexion() as con:
+        cur = con.execute("UPDATE usuarios SET password = ? WHERE usuario = ?",
+                          (pass_hash, usuario.strip().lower()))
+    return cur.rowcount > 0
+
+# --- CONFIGURACIÓN ---
+def leer_config(usuario):
+    rows = _conexion().execute(
+        "SELECT clave, valor FROM config WHERE usuario = ? ORDER BY orden",
+        (usuario.strip().lower(),)
+    ).fetchall()
+    return {r["clave"]: r["valor"] for r in rows}
+
+def leer_config_clave(usuario, clave):
+    row = _conexion().execute(
+        "SELECT valor FROM config WHERE usuario = ? AND clave = ?",
+        (usuario.strip().lower(), clave)
+    ).fetchone()
+    return row["valor"] if row else None
+
+def escribir_config(usuario, filas):
+    u = usuario.strip().lower()
+    with _conexion() as con:
+        con.execute("DELETE FROM config WHERE usuario = ?", (u,))
+        con.executemany(
+            "INSERT INTO config (usuario, clave, valor, orden) VALUES (?, ?, ?, ?)",
+            [(u, str(clave), str(valor), i) for i, (clave, valor) in enumerate(filas)]
+        )
+    return True
+
+def actualizar_config(usuario, cambios):
+    u = usuario.strip().lower()
+    with _conexion() as con:
+        siguiente = con.execute("SELECT COALESCE(MAX(orden), -1) + 1 FROM config WHERE usuario = ?", (u,)).fetchone()[0]
+        con.executemany(
+            "INSERT INTO config (usuario, clave, valor, orden) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (usuario, clave) DO UPDATE SET valor = excluded.valor",
+            [(u, str(clave), str(valor), siguiente + i) for i, (clave, valor) in enumerate(cambios.items())]
+        )
+    return True
+
+# --- HISTORIAL ---
+def leer_historial_dia(usuario, fecha_str, columnas=None):
+    rows = _conexion().execute(
+        f"SELECT {_select_historial(columnas)} FROM historial WHERE usuario = ? AND fecha = ?",
+        (usuario.strip().lower(), fecha_str)
+    ).fetchall()
+    return [_registro(r) for r in rows]
+
+def leer_historial_rango(usuario, desde_str, hasta_str, columnas=None):
+    rows = _conexion().execute(
+        f"SELECT {_select_historial(columnas)} FROM historial "
+        "WHERE usuario = ? AND fecha BETWEEN ? AND ? ORDER BY fecha",
+        (usuario.strip().lower(), desde_str, hasta_str)
+    ).fetchall()
+    return [_registro(r) for r in rows]
+
+def agregar_historial(usuario, registro):
+    # (usuario, fecha) es clave primaria: agregar un día existente lo reemplaza
+    r = registro
+    with _conexion() as con:
+        con.execute(
+            "INSERT OR REPLACE INTO historial (usuario, fecha, autor, json, creado, actualizado) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (usuario.strip().lower(), r["fecha"], r["usuario"], r["json"], r["creado"], r["actualizado"])
+        )
+    return True
+
+def upsert_historial(usuario, registro):
+    r = registro
+    with _conexion() as con:
+        con.execute(
+            "INSERT INTO historial (usuario, fecha, autor, json, creado, actualizado) "
+            "VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (usuario, fecha) DO UPDATE SET "
+            "autor = excluded.autor, json = excluded.json, actualizado = excluded.actualizado",
+            (usuario.strip().lower(), r["fecha"], r["usuario"], r["json"], r["creado"], r["actualizado"])
+        )
+    return True
+
+def eliminar_historial(usuario, fecha_str):
+    with _conexion() as con:
+        con.execute("DELETE FROM historial WHERE usuario = ? AND fecha = ?",
+                    (usuario.strip().lower(), fecha_str))
+    return True
+
+def leer_historial_anterior(usuario, fecha_str):
+    rows = _conexion().execute(
+        "SELECT * FROM historial WHERE usuario = ? AND fecha < ? ORDER BY fecha",
+        (usuario.strip().lower(), fecha_str)
+    ).fetchall()
+    return [_registro(r) for r in rows]
+
+def eliminar_historial_anterior(usuario, archivados):
+    """Borra los días archivados [(fecha, actualizado)] que no se han vuelto a editar."""
+    u = usuario.strip().lower()
+    with _conexion() as con:
+        con.executemany("DELETE FROM historial WHERE usuario = ? AND fecha = ? AND actualizado = ?",
+                        [(u, fecha, actualizado) for fecha, actualizado in archivados])
+    return True
+
+def compactar_historial(usuario):
+    """
+    (usuario, fecha) es clave primaria, así que no puede haber duplicados y no
+    hay nada que reescribir. Solo se informa de las filas y bytes del usuario;
+    el espacio libre del fichero es de toda la base y no se toca desde aquí.
+    """
+    filas, tamano = _conexion().execute(
+        "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(fecha || autor || json || creado || actualizado AS BLOB))), 0) "
+        "FROM historial WHERE usuario = ?",
+        (usuario.strip().lower(),)
+    ).fetchone()
+    return {"filas_antes": filas, "filas_despues": filas, "bytes_antes": tamano, "bytes_despues": tamano}
+
+# --- TALLER ---
+def leer_eventos_taller(usuario, desde=0):
+    rows = _conexion().execute(
+        "SELECT momento, unidad, estado, autor FROM taller_eventos "
+        "WHERE usuario = ? ORDER BY id LIMIT -1 OFFSET ?",
+        (usuario.strip().lower(), desde)
+    ).fetchall()
+    return [{"momento": r["momento"], "unidad": r["unidad"], "estado": r["estado"], "usuario": r["autor"]} for r in rows]
+
+def agregar_eventos_taller(usuario, eventos):
+    """Añade los eventos y devuelve la posición (0-based) del primero en el registro."""
+    u = usuario.strip().lower()
+    con = _conexion()
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        pos = con.execute("SELECT COUNT(*) FROM taller_eventos WHERE usuario = ?", (u,)).fetchone()[0]
+        con.executemany(
+            "INSERT INTO taller_eventos (usuario, momento, unidad, estado, autor) VALUES (?, ?, ?, ?, ?)",
+            [(u, e["momento"], int(e["unidad"]), e["estado"], e["usuario"]) for e in eventos]
+        )
+        con.commit()
+    except Exception:
+        con.rollback()
+        raise
+    return pos
+
+# --- ARRANQUE ---
+def leer_inicio(usuario, fecha_str, desde_taller=0):
+    return {
+        "config": leer_config(usuario),
+        "eventos_taller": leer_eventos_taller(usuario, desde_taller),
+        "historial": leer_historial_dia(usuario, fecha_str)
+    }
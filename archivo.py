@@ -0,0 +1,84 @@
+"""
+Archivo frío del historial.
+
+Los días que superan la retención salen de la base de datos y se guardan aquí:
+un fichero JSON Lines comprimido con gzip por usuario y mes
+(<RUTA_ARCHIVO>/<usuario>/AAAA_MM.jsonl.gz), con los mismos registros que
+devuelve el backend. Solo se abre cuando una consulta llega a fechas
+archivadas. Es disco local: en servidores sin disco persistente no conviene
+activar la retención (historial_retencion_meses = 0 por defecto).
+"""
+import gzip
+import json
+import os
+import threading
+
+from almacenamiento import leer_ajuste
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RUTA_ARCHIVO = leer_ajuste("archivo_ruta", os.path.join(BASE_DIR, "archivo_historial"))
+
+_lock = threading.Lock()
+_meses = {}  # usuario -> lista ordenada de 'AAAA-MM' archivados
+
+def _carpeta(usuario):
+    return os.path.join(RUTA_ARCHIVO, usuario.strip().lower())
+
+def _ruta(usuario, mes):
+    return os.path.join(_carpeta(usuario), f"{mes.replace('-', '_')}.jsonl.gz")
+
+def meses_archivados(usuario):
+    u = usuario.strip().lower()
+    with _lock:
+        if u not in _meses:
+            try: nombres = os.listdir(_carpeta(u))
+            except FileNotFoundError: nombres = []
+            _meses[u] = sorted(n[:7].replace("_", "-") for n in nombres if n.endswith(".jsonl.gz"))
+        return list(_meses[u])
+
+def cubre(usuario, desde_str):
+    """True si hay días archivados en o después del mes de desde_str."""
+    meses = meses_archivados(usuario)
+    return bool(meses) and desde_str[:7] <= meses[-1]
+
+def _leer_mes(usuario, mes):
+    try:
+        with gzip.open(_ruta(usuario, mes), "rt", encoding="utf-8") as f:
+            return [json.loads(linea) for linea in f if linea.strip()]
+    except FileNotFoundError:
+        return []
+
+def leer_rango(usuario, desde_str, hasta_str):
+    """Registros archivados entre desde y hasta, en orden de fecha."""
+    registros = []
+    for mes in meses_archivados(usuario):
+        if desde_str[:7] <= mes <= hasta_str[:7]:
+            registros += [r for r in _leer_mes(usuario, mes) if desde_str <= r["fecha"] <= hasta_str]
+    return registros
+
+def archivar(usuario, registros):
+    """
+    Añade los registros a sus ficheros mensuales (un día ya archivado se
+    sustituye por el nuevo) y devuelve los bytes escritos en disco.
+    """
+    u = usuario.strip().lower()
+    por_mes = {}
+    for r in registros:
+        por_mes.setdefault(r["fecha"][:7], []).append(r)
+
+    os.makedirs(_carpeta(u), exist_ok=True)
+    escritos = 0
+    for mes, nuevos in por_mes.items():
+        dias = {r["fecha"]: r for r in _leer_mes(u, mes)}
+        for r in nuevos: dias[r["fecha"]] = r
+        ruta = _ruta(u, mes)
+        # Escritura atómica: un fallo a medias no deja el mes corrupto
+        with gzip.open(ruta + ".tmp", "wt", encoding="utf-8") as f:
+            for fecha in sorted(dias):
+                f.write(json.dumps(dias[fecha], ensure_ascii=False) + "\n")
+        os.replace(ruta + ".tmp", ruta)
+        escritos += os.path.getsize(ruta)
+
+    with _lock:
+        _meses.pop(u, None)
+    return escritos
@@ -0,0 +1,119 @@
+"""
+Escritor en segundo plano para el historial.
+
+Un único hilo procesa los guardados en orden. Hay como mucho un trabajo
+pendiente por (usuario, fecha): si llega otro guardado del mismo día antes de
+que se escriba, el anterior queda 'reemplazado' y solo se escribe el último.
+Cada trabajo guarda su estado (pendiente, en_curso, hecho, fallido) y su
+latencia para que la interfaz pueda mostrar si de verdad se guardó.
+"""
+import copy
+import itertools
+import threading
+import time
+from collections import OrderedDict
+
+from database import upsert_historial
+from almacenamiento.planificador import prioridad, FONDO
+
+# Espera antes de escribir un lote, para absorber guardados repetidos seguidos
+VENTANA_COALESCENCIA = 0.3
+MAX_TRABAJOS_RECORDADOS = 500
+
+_cond = threading.Condition()
+_pendientes = OrderedDict()  # (usuario, fecha) -> id de trabajo
+_trabajos = OrderedDict()    # id -> trabajo
+_contador = itertools.count(1)
+_hilo = None
+
+def _arrancar_hilo():
+    global _hilo
+    if _hilo is None or not _hilo.is_alive():
+        _hilo = threading.Thread(target=_bucle, name="escritor-historial", daemon=True)
+        _hilo.start()
+
+def _podar():
+    terminados = [i for i, t in _trabajos.items() if t["estado"] in ("hecho", "fallido", "reemplazado")]
+    for i in terminados[:max(0, len(_trabajos) - MAX_TRABAJOS_RECORDADOS)]:
+        del _trabajos[i]
+
+def encolar_guardado(fecha, reporte, usuario):
+    """Encola el reporte del día y devuelve el id del trabajo."""
+    clave = (usuario.strip().lower(), fecha.strftime("%Y-%m-%d"))
+    with _cond:
+        id_t = next(_contador)
+        _trabajos[id_t] = {
+            "id": id_t,
+            "usuario": clave[0],
+            "fecha": clave[1],
+            "estado": "pendiente",
+            "encolado": time.time(),
+            "terminado": None,
+            "latencia": None,
+            "error": None,
+            "reemplazado_por": None,
+            # Copia: la sesión sigue editando su lista mientras esperamos
+            "_args": (fecha, copy.deepcopy(reporte), usuario)
+        }
+        anterior = _pendientes.get(clave)
+        if anterior is not None:
+            _trabajos[anterior]["estado"] = "reemplazado"
+            _trabajos[anterior]["reemplazado_por"] = id_t
+            _trabajos[anterior].pop("_args", None)
+        _pendientes[clave] = id_t
+        _podar()
+        _arrancar_hilo()
+        _cond.notify()
+    return id_t
+
+def estado_guardado(id_trabajo):
+    """Estado del trabajo; si fue reemplazado, el del guardado que lo sustituyó."""
+    with _cond:
+        t = _trabajos.get(id_trabajo)
+        while t is not None and t["reemplazado_por"] is not None:
+            t = _trabajos.get(t["reemplazado_por"])
+        if t is None: return None
+        return {k: v for k, v in t.items() if not k.startswith("_")}
+
+def resumen_cola():
+    with _cond:
+        estados = [t["estado"] for t in _trabajos.values()]
+        latencias = [t["latencia"] for t in _trabajos.values() if t["estado"] == "hecho"]
+        return {
+            "pendientes": len(_pendientes),
+            "en_curso": estados.count("en_curso"),
+            "hechos": estados.count("hecho"),
+            "fallidos": estados.count("fallido"),
+            "reemplazados": estados.count("reemplazado"),
+            "latencia_media": (sum(latencias) / len(latencias)) if latencias else None
+        }
+
+def _bucle():
+    while True:
+        with _cond:
+            while not _pendientes: _cond.wait()
+        time.sleep(VENTANA_COALESCENCIA)
+
+        with _cond:
+            lote = list(_pendientes.values())
+            _pendientes.clear()
+            for id_t in lote: _trabajos[id_t]["estado"] = "en_curso"
+
+        for id_t in lote:
+            with _cond: args = _trabajos[id_t].pop("_args")
+            error = None
+            try:
+                # Las lecturas interactivas de las sesiones pasan antes que estas escrituras
+                with prioridad(FONDO):
+                    if not upsert_historial(*args): error = "No se pudo guardar en la base de datos."
+            except Exception as e:
+                error = str(e)
+
+            with _cond:
+                t = _trabajos[id_t]
+                t["terminado"] = time.time()
+                t["latencia"] = t["terminado"] - t["encolado"]
+                t["estado"] = "fallido" if error else "hecho"
+                t["error"] = error
+            if error: print(f"❌ [Segundo Plano] Error guardando {t['fecha']} de {t['usuario']}: {error}")
+            else: print(f"✅ [Segundo Plano] Guardado completado para {t['usuario']}")
@@ -1,88 +1,63 @@
 import streamlit as st
-import gspread
 import hashlib
 import json
 import pyotp
+import copy
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 import pytz
 
-NOMBRE_HOJA = "DB_GestorFlota"
+from almacenamiento import obtener_backend, leer_ajuste, SEPARADOR_PARTICION
+from almacenamiento.planificador import prioridad, FONDO
+import archivo
+import eventos
 
-# --- CONEXIÓN ---
-def conectar_google_sheets():
-    try:
-        if "gcp_service_account" in st.secrets:
-            creds_dict = dict(st.secrets["gcp_service_account"])
-            gc = gspread.service_account_from_dict(creds_dict)
-            return gc.open(NOMBRE_HOJA)
-        else:
-            gc = gspread.service_account("datos_sistema.json")
-            return gc.open(NOMBRE_HOJA)
-    except Exception as e:
-        print(f"Error de conexión: {e}")
-        return None
+def _backend():
+    return obtener_backend()
 
 def hacer_hash(texto):
     return hashlib.sha256(str(texto).encode('utf-8')).hexdigest()
 
-def asegurar_pestana(sh, nombre):
-    try:
-        return sh.worksheet(nombre)
-    except:
-        return sh.add_worksheet(nombre, 100, 20)
-
 # --- USUARIOS ---
 def validar_usuario_db(usuario, password):
-    sh = conectar_google_sheets()
-    if not sh: return False
     try:
-        ws = sh.worksheet("Usuarios")
-        registros = ws.get_all_records()
-        pass_hash = hacer_hash(password)
-        for reg in registros:
-            if str(reg['Usuario']).strip().lower() == usuario.strip().lower():
-                if str(reg['Password']) == pass_hash:
-                    return True
+        reg = _backend().buscar_usuario(usuario)
+        return bool(reg) and str(reg["password"]) == hacer_hash(password)
+    except Exception as e:
+        _backend().registrar_fallo(e)
         return False
-    except: return False
 
 def registrar_usuario_con_totp(usuario, password, totp_secret):
-    sh = conectar_google_sheets()
-    if not sh: return False, "Error conexión."
     usuario_limpio = usuario.strip().lower()
+    if SEPARADOR_PARTICION in usuario_limpio: return False, f"El usuario no puede contener '{SEPARADOR_PARTICION}'."
     try:
-        ws = sh.worksheet("Usuarios")
-        usuarios_existentes = [str(u).lower() for u in ws.col_values(1)]
-        if usuario_limpio in usuarios_existentes: return False, "Usuario ya existe."
+        if _backend().buscar_usuario(usuario_limpio): return False, "Usuario ya existe."
         pass_hash = hacer_hash(password)
-        ws.append_row([usuario_limpio, pass_hash, totp_secret])
+        _backend().crear_usuario(usuario_limpio, pass_hash, totp_secret)
         return True, "Registrado."
-    except Exception as e: return False, f"Error: {e}"
+    except ConnectionError: return False, "Error conexión."
+    except Exception as e:
+        _backend().registrar_fallo(e)
+        return False, f"Error: {e}"
 
 def restablecer_con_totp(usuario, codigo_input, nueva_password):
-    sh = conectar_google_sheets()
-    if not sh: return False, "Error conexión."
     try:
-        ws = sh.worksheet("Usuarios")
-        filas = ws.get_all_values()
-        u_target = usuario.strip().lower()
-        for i, fila in enumerate(filas):
-            if i == 0: continue
-            if len(fila) >= 3 and str(fila[0]).strip().lower() == u_target:
-                secret = str(fila[2])
-                totp = pyotp.TOTP(secret)
-                if totp.verify(codigo_input, valid_window=1):
-                    ws.update_cell(i + 1, 2, hacer_hash(nueva_password))
-                    return True, "Contraseña cambiada."
-                else: return False, "Código inválido."
-        return False, "Usuario no encontrado."
-    except: return False, "Error inesperado."
+        reg = _backend().buscar_usuario(usuario)
+        if not reg: return False, "Usuario no encontrado."
+        totp = pyotp.TOTP(str(reg["totp"]))
+        if not totp.verify(codigo_input, valid_window=1): return False, "Código inválido."
+        _backend().cambiar_password(usuario, hacer_hash(nueva_password))
+        return True, "Contraseña cambiada."
+    except ConnectionError: return False, "Error conexión."
+    except Exception as e:
+        _backend().registrar_fallo(e)
+        return False, "Error inesperado."
 
 # --- CONFIGURACIÓN ---
-def cargar_datos_db(usuario):
-    sh = conectar_google_sheets()
-    if not sh: return {}
-    
+def _config_desde_dict(config_dict):
     # Datos por defecto
     datos = {
         "rangos": [[1, 500]],
@@ -95,220 +70,569 @@ def cargar_datos_db(usuario):
         "st_colors": ["#f8d7da"]*6
     }
     
+    # 1. RANGOS
+    if "Rangos" in config_dict:
+        txt = config_dict["Rangos"]
+        try:
+            parsed = []
+            for p in txt.split(','):
+                if '-' in p:
+                    a, b = p.split('-')
+                    parsed.append([int(a), int(b)])
+            if parsed: datos["rangos"] = parsed
+        except: pass
+
+    # 2. ESTACIONES
+    if "Estaciones" in config_dict:
+        txt = config_dict["Estaciones"]
+        if txt:
+            datos["estaciones"] = [e.strip() for e in txt.split(';;') if e.strip()]
+
+    # 3. AVERIADAS
+    if "Averiadas" in config_dict:
+        txt = config_dict["Averiadas"]
+        if txt:
+            datos["averiadas"] = [int(x) for x in txt.split(',') if x.strip().isdigit()]
+
+    # 4. APARIENCIA
     try:
-        nombre_pestana = f"Config_{usuario.strip().lower()}"
-        ws = asegurar_pestana(sh, nombre_pestana)
-        
-        raw_data = ws.get_all_values()
-        config_dict = {}
-        for fila in raw_data:
-            if len(fila) >= 2:
-                config_dict[str(fila[0]).strip()] = str(fila[1]).strip()
-        
-        # 1. RANGOS
-        if "Rangos" in config_dict:
-            txt = config_dict["Rangos"]
-            try:
-                parsed = []
-                for p in txt.split(','):
-                    if '-' in p:
-                        a, b = p.split('-')
-                        parsed.append([int(a), int(b)])
-                if parsed: datos["rangos"] = parsed
-            except: pass
-
-        # 2. ESTACIONES
-        if "Estaciones" in config_dict:
-            txt = config_dict["Estaciones"]
-            if txt:
-                datos["estaciones"] = [e.strip() for e in txt.split(';;') if e.strip()]
-
-        # 3. AVERIADAS
-        if "Averiadas" in config_dict:
-            txt = config_dict["Averiadas"]
-            if txt:
-                datos["averiadas"] = [int(x) for x in txt.split(',') if x.strip().isdigit()]
-
-        # 4. APARIENCIA
         if "FontSize" in config_dict: datos["font_size"] = int(config_dict["FontSize"])
         if "ImgWidth" in config_dict: datos["img_width"] = int(config_dict["ImgWidth"])
-        if "BgColor" in config_dict: datos["bg_color"] = config_dict["BgColor"]
-        if "TextColor" in config_dict: datos["text_color"] = config_dict["TextColor"]
-        if "StColors" in config_dict:
-            try: datos["st_colors"] = json.loads(config_dict["StColors"])
-            except: pass
-
-    except Exception as e:
-        print(f"Error cargando config: {e}")
-        
+    except ValueError: pass
+    if "BgColor" in config_dict: datos["bg_color"] = config_dict["BgColor"]
+    if "TextColor" in config_dict: datos["text_color"] = config_dict["TextColor"]
+    if "StColors" in config_dict:
+        try: datos["st_colors"] = json.loads(config_dict["StColors"])
+        except: pass
     return datos
 
-def obtener_fecha_creacion_original(fecha, usuario):
-    sh = conectar_google_sheets()
-    if not sh: return None
-    try:
-        nombre_pestana = f"Historial_{usuario.strip().lower()}"
-        ws = asegurar_pestana(sh, nombre_pestana)
-        
-        fecha_target = fecha.strftime("%Y-%m-%d")
-        records = ws.get_all_records() # Devuelve lista de diccionarios
-        
-        for r in records:
-            if str(r.get("Fecha")) == fecha_target:
-                # Retornamos lo que haya en la columna 'Creado'
-                return r.get("Creado", None)
-        return None
-    except: return None
+def _filas_desde_config(datos):
+    txt_rangos = ", ".join([f"{r[0]}-{r[1]}" for r in datos.get("rangos", [[1,500]])])
+    txt_estaciones = ";;".join(datos.get("estaciones", []))
+    txt_averiadas = ", ".join(map(str, datos.get("averiadas", [])))
+    json_colors = json.dumps(datos.get("st_colors", ["#fff"]*6))
+    
+    return [
+        ["Rangos", txt_rangos],
+        ["Estaciones", txt_estaciones],
+        ["Averiadas", txt_averiadas],
+        ["FontSize", datos.get("font_size", 24)],
+        ["ImgWidth", datos.get("img_width", 450)],
+        ["BgColor", datos.get("bg_color", "#ECE5DD")],
+        ["TextColor", datos.get("text_color", "#000000")],
+        ["StColors", json_colors]
+    ]
 
-def recuperar_historial_rango(usuario, f_inicio, f_fin):
-    sh = conectar_google_sheets()
-    if not sh: return []
-    try:
-        nombre_pestana = f"Historial_{usuario.strip().lower()}"
-        ws = asegurar_pestana(sh, nombre_pestana)
-        
-        try: records = ws.get_all_records()
-        except: return []
-        
-        resultados = []
-        
-        s_inicio = f_inicio.strftime("%Y-%m-%d")
-        s_fin = f_fin.strftime("%Y-%m-%d")
-        
-        for r in records:
-            fecha_str = str(r.get("Fecha"))
-            if s_inicio <= fecha_str <= s_fin:
+# Último estado persistido de cada usuario ({clave: valor}), leído o escrito
+# por este proceso. Permite escribir solo las claves que cambian.
+_config_persistida = {}
+_config_lock = threading.Lock()
+
+# Config ya interpretada, compartida por todas las sesiones del mismo usuario.
+# Caduca a los TTL_CONFIG segundos y cada guardado la actualiza (write-through).
+TTL_CONFIG = float(leer_ajuste("config_ttl", 60))
+_cache_config = {}
+_cargas_config = {}
+_stats_cache_config = {"aciertos": 0, "fallos": 0}
+
+def _recordar_config(usuario, pares):
+    with _config_lock:
+        _config_persistida[usuario.strip().lower()] = {str(k).strip(): str(v).strip() for k, v in pares}
+
+def _cachear_config(usuario, datos):
+    datos = copy.deepcopy(datos)
+    datos.pop("averiadas", None)  # se deriva del registro de taller
+    with _config_lock:
+        _cache_config[usuario.strip().lower()] = {"datos": datos, "expira": time.monotonic() + TTL_CONFIG}
+
+def _config_cacheada(usuario):
+    with _config_lock:
+        entrada = _cache_config.get(usuario.strip().lower())
+        if entrada and entrada["expira"] > time.monotonic():
+            return copy.deepcopy(entrada["datos"])
+    return None
+
+def invalidar_cache_config(usuario):
+    with _config_lock:
+        _cache_config.pop(usuario.strip().lower(), None)
+
+def estadisticas_cache_config():
+    with _config_lock:
+        total = _stats_cache_config["aciertos"] + _stats_cache_config["fallos"]
+        return {
+            **_stats_cache_config,
+            "usuarios": len(_cache_config),
+            "tasa_aciertos": (_stats_cache_config["aciertos"] / total) if total else None
+        }
+
+def _lock_de(locks, clave):
+    with _config_lock:
+        return locks.setdefault(clave, threading.Lock())
+
+def cargar_datos_db(usuario):
+    u = usuario.strip().lower()
+    datos = _config_cacheada(u)
+    if datos is None:
+        # Una sola lectura por usuario aunque varias sesiones fallen a la vez
+        with _lock_de(_cargas_config, u):
+            datos = _config_cacheada(u)
+            if datos is None:
+                with _config_lock: _stats_cache_config["fallos"] += 1
                 try:
-                    data = {
-                        "fecha": fecha_str,
-                        "reporte": json.loads(r.get("JSON", "[]")),
-                        "creado": r.get("Creado", ""),
-                        "actualizado": r.get("Actualizado", "")
-                    }
-                    resultados.append(data)
-                except: pass
-                
-        # Ordenamos: El más reciente primero
-        resultados.sort(key=lambda x: x["fecha"], reverse=True)
-        return resultados
-    except Exception as e:
-        print(f"Error historial rango: {e}")
-        return []
+                    config_dict = _backend().leer_config(u)
+                    _recordar_config(u, config_dict.items())
+                    datos = _config_desde_dict(config_dict)
+                    datos["averiadas"] = averiadas_taller(u)
+                    _cachear_config(u, datos)
+                    return datos
+                except ConnectionError: return {}
+                except Exception as e:
+                    _backend().registrar_fallo(e)
+                    print(f"Error cargando config: {e}")
+                    return _config_desde_dict({})
+    
+    with _config_lock: _stats_cache_config["aciertos"] += 1
+    # El taller se mantiene al día en memoria con cada evento registrado
+    datos["averiadas"] = averiadas_taller(u, refrescar=False)
+    return datos
 
-def guardar_datos_db(datos, usuario):
-    sh = conectar_google_sheets()
-    if not sh: return False
+def _persistir_config(usuario, filas, completo):
+    with _config_lock:
+        previo = _config_persistida.get(usuario.strip().lower())
     
+    if previo is not None and not completo:
+        cambios = {k: str(v).strip() for k, v in filas if previo.get(k) != str(v).strip()}
+        if not cambios: return True
+        try:
+            _backend().actualizar_config(usuario, cambios)
+            _recordar_config(usuario, list(previo.items()) + list(cambios.items()))
+            return True
+        except ConnectionError: raise
+        except Exception as e:
+            _backend().registrar_fallo(e)
+            print(f"Escritura parcial de config fallida, reescribiendo: {e}")
+    
+    _backend().escribir_config(usuario, filas)
+    _recordar_config(usuario, filas)
+    return True
+
+def guardar_datos_db(datos, usuario, completo=False):
+    """
+    Persiste la config escribiendo solo las claves que cambiaron respecto a lo
+    último persistido. Con completo=True (o sin estado previo conocido) reescribe
+    la pestaña entera, que queda como vía de reparación.
+    """
     try:
-        nombre_pestana = f"Config_{usuario.strip().lower()}"
-        ws = asegurar_pestana(sh, nombre_pestana)
-        
-        txt_rangos = ", ".join([f"{r[0]}-{r[1]}" for r in datos.get("rangos", [[1,500]])])
-        txt_estaciones = ";;".join(datos.get("estaciones", []))
-        txt_averiadas = ", ".join(map(str, datos.get("averiadas", [])))
-        json_colors = json.dumps(datos.get("st_colors", ["#fff"]*6))
-        
-        rows = [
-            ["Rangos", txt_rangos],
-            ["Estaciones", txt_estaciones],
-            ["Averiadas", txt_averiadas],
-            ["FontSize", datos.get("font_size", 24)],
-            ["ImgWidth", datos.get("img_width", 450)],
-            ["BgColor", datos.get("bg_color", "#ECE5DD")],
-            ["TextColor", datos.get("text_color", "#000000")],
-            ["StColors", json_colors]
-        ]
-        
-        ws.clear()
-        ws.update(range_name="A1", values=rows)
+        # La nueva revisión viaja en la misma escritura que los cambios
+        rev = _nueva_revision()
+        _persistir_config(usuario, _filas_desde_config(datos) + [["Revision", rev]], completo)
+        _cachear_config(usuario, datos)
+        _marcar_revision(usuario, rev)
+        eventos.publicar(usuario, "config", datos={k: copy.deepcopy(v) for k, v in datos.items() if k != "averiadas"})
         return True
+    except ConnectionError:
+        invalidar_cache_config(usuario)
+        return False
     except Exception as e:
+        _backend().registrar_fallo(e)
+        invalidar_cache_config(usuario)
         st.error(f"Error guardando: {e}")
         return False
 
-# --- HISTORIAL (CORREGIDO) ---
-def guardar_historial_db(fecha, reporte, usuario, fecha_creacion_preservada=None):
-    sh = conectar_google_sheets()
-    if not sh: return False
+# --- REVISIÓN ---
+# Marca que cambia con cada escritura del usuario (config, taller, historial),
+# guardada como clave 'Revision' de su config. El Modo Vivo solo consulta esta
+# marca y recarga cuando cambia; la lectura se comparte entre sesiones durante
+# TTL_REVISION segundos y las escrituras de este proceso la actualizan sin leer.
+TTL_REVISION = float(leer_ajuste("revision_ttl", 5))
+_revisiones = {}
+_lecturas_revision = {}
+
+def _nueva_revision():
+    return uuid.uuid4().hex[:12]
+
+def _marcar_revision(usuario, rev):
+    with _config_lock:
+        u = usuario.strip().lower()
+        _revisiones[u] = {"valor": rev, "leida": time.monotonic()}
+        if u in _config_persistida: _config_persistida[u]["Revision"] = rev
+
+def _publicar_revision(usuario):
+    rev = _nueva_revision()
+    try: _backend().actualizar_config(usuario, {"Revision": rev})
+    except Exception as e:
+        _backend().registrar_fallo(e)
+        print(f"Error publicando revisión: {e}")
+    _marcar_revision(usuario, rev)
+
+def revision_datos(usuario):
+    """Revisión actual de los datos del usuario. Si cambió por fuera, invalida la caché."""
+    u = usuario.strip().lower()
+    with _lock_de(_lecturas_revision, u):
+        with _config_lock: previa = _revisiones.get(u)
+        if previa and time.monotonic() - previa["leida"] < TTL_REVISION:
+            return previa["valor"]
+        try:
+            remota = _backend().leer_config_clave(u, "Revision") or ""
+        except Exception as e:
+            _backend().registrar_fallo(e)
+            return previa["valor"] if previa else ""
+        if previa is not None and remota != previa["valor"]:
+            # Cambio hecho desde fuera: ni la config, ni los rangos, ni lo que el
+            # backend recuerda de la hoja (índices de fechas) siguen valiendo
+            invalidar_cache_config(u)
+            invalidar_cache_historial(u)
+            _backend().invalidar_usuario(u)
+        _marcar_revision(u, remota)
+        return remota
+
+# --- TALLER ---
+# Cada alta/baja de taller es un evento que solo se añade al registro
+# (Taller_<usuario>). El estado actual y las estadísticas se derivan de él y se
+# mantienen en memoria aplicando solo los eventos nuevos. La clave 'Averiadas'
+# de la config queda como espejo/valor heredado mientras el registro esté vacío.
+FORMATO_MOMENTO = "%Y-%m-%d %H:%M:%S"
+
+_taller = {}
+_taller_lock = threading.Lock()
+
+def _segundos_entre(desde, hasta):
     try:
-        nombre_pestana = f"Historial_{usuario.strip().lower()}"
-        ws = asegurar_pestana(sh, nombre_pestana)
-        
-        # Nuevos encabezados
-        nuevos_encabezados = ["Fecha", "Usuario", "JSON", "Creado", "Actualizado"]
-        
-        # Verificamos/Actualizamos encabezados
-        primera_fila = ws.row_values(1)
-        if not primera_fila:
-            ws.append_row(nuevos_encabezados)
-        elif len(primera_fila) < 5 and "Creado" not in primera_fila:
-            ws.update(range_name="D1:E1", values=[["Creado", "Actualizado"]])
-
-        fecha_str = fecha.strftime("%Y-%m-%d")
-        json_reporte = json.dumps(reporte, ensure_ascii=False)
-        
-        ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
-        creado = fecha_creacion_preservada if fecha_creacion_preservada else ahora
-        actualizado = ahora
-        
-        # Guardamos con las 5 columnas
-        ws.append_row([fecha_str, usuario, json_reporte, creado, actualizado])
-        return True
-    except Exception as e: 
-        print(f"Error guardando historial: {e}")
-        return False
+        return (datetime.strptime(hasta, FORMATO_MOMENTO) - datetime.strptime(desde, FORMATO_MOMENTO)).total_seconds()
+    except (TypeError, ValueError): return 0.0
 
-def recuperar_historial_por_fecha(fecha, usuario):
-    sh = conectar_google_sheets()
-    if not sh: return []
+def _aplicar_evento(estado, ev):
+    estado["n"] += 1
+    if ev["unidad"] is None: return
+    u = estado["unidades"].setdefault(ev["unidad"], {
+        "estado": "operativa", "desde": None, "reparaciones": 0, "medidas": 0, "segundos_taller": 0.0
+    })
+    if ev["estado"] == "averiada" and u["estado"] != "averiada":
+        u["estado"], u["desde"] = "averiada", ev["momento"]
+    elif ev["estado"] == "reparada" and u["estado"] == "averiada":
+        u["reparaciones"] += 1
+        if u["desde"]:  # las heredadas de la config no tienen fecha de entrada
+            u["medidas"] += 1
+            u["segundos_taller"] += _segundos_entre(u["desde"], ev["momento"])
+        u["estado"], u["desde"] = "operativa", ev["momento"]
+
+def _estado_taller(usuario, refrescar=True):
+    """Estado derivado del registro, al día: solo descarga los eventos nuevos."""
+    u = usuario.strip().lower()
+    with _taller_lock:
+        estado = _taller.setdefault(u, {"n": 0, "unidades": {}, "lock": threading.Lock()})
+    if refrescar:
+        with estado["lock"]:
+            for ev in _backend().leer_eventos_taller(u, estado["n"]):
+                _aplicar_evento(estado, ev)
+    return estado
+
+def _averiadas_heredadas(usuario):
+    with _config_lock:
+        txt = _config_persistida.get(usuario.strip().lower(), {}).get("Averiadas", "")
+    return [int(x) for x in txt.split(',') if x.strip().isdigit()]
+
+def averiadas_taller(usuario, refrescar=True):
+    try: estado = _estado_taller(usuario, refrescar)
+    except Exception as e:
+        _backend().registrar_fallo(e)
+        print(f"Error leyendo taller: {e}")
+        estado = _estado_taller(usuario, refrescar=False)
+    if estado["n"] == 0: return sorted(_averiadas_heredadas(usuario))
+    return sorted(n for n, u in estado["unidades"].items() if u["estado"] == "averiada")
+
+def registrar_eventos_taller(usuario, cambios):
+    """
+    Añade al registro de taller los cambios [(unidad, 'averiada'|'reparada'), ...]
+    en una sola escritura. Devuelve la lista de averiadas resultante o None si falla.
+    """
+    u = usuario.strip().lower()
+    ahora = datetime.now().strftime(FORMATO_MOMENTO)
+    nuevos = [{"momento": ahora, "unidad": int(n), "estado": e, "usuario": u} for n, e in cambios]
     try:
-        nombre_pestana = f"Historial_{usuario.strip().lower()}"
-        ws = asegurar_pestana(sh, nombre_pestana)
+        estado = _estado_taller(u)
+        if estado["n"] == 0:
+            # Primer evento: sembramos las averiadas heredadas de la config
+            semilla = [{"momento": "", "unidad": n, "estado": "averiada", "usuario": "migracion"}
+                       for n in _averiadas_heredadas(u)]
+            nuevos = semilla + nuevos
+        if not nuevos: return averiadas_taller(u)
         
+        pos = _backend().agregar_eventos_taller(u, nuevos)
+        _publicar_revision(u)
+        with estado["lock"]:
+            al_dia = (pos == estado["n"])
+            if al_dia:
+                for ev in nuevos: _aplicar_evento(estado, ev)
+        # Si alguien escribió en medio, nos ponemos al día leyendo lo nuevo
+        nuevas = averiadas_taller(u, refrescar=not al_dia)
+        eventos.publicar(u, "taller", averiadas=nuevas)
+        return nuevas
+    except Exception as e:
+        _backend().registrar_fallo(e)
+        print(f"Error registrando taller: {e}")
+        return None
+
+def estadisticas_taller(usuario):
+    """
+    Por unidad: estado, desde cuándo, reparaciones y horas totales en taller.
+    Sin peticiones: el estado ya lo tienen al día la carga de datos y cada
+    registro de eventos, y esto se pinta en cada rerun de la vista.
+    """
+    estado = _estado_taller(usuario, refrescar=False)
+    ahora = datetime.now().strftime(FORMATO_MOMENTO)
+    filas = []
+    with estado["lock"]:
+        for n, u in sorted(estado["unidades"].items()):
+            segundos = u["segundos_taller"]
+            if u["estado"] == "averiada": segundos += _segundos_entre(u["desde"], ahora)
+            filas.append({
+                "unidad": n,
+                "estado": u["estado"],
+                "desde": u["desde"] or "",
+                "reparaciones": u["reparaciones"],
+                "horas_taller": round(segundos / 3600, 1),
+                "horas_media_reparacion": round(u["segundos_taller"] / 3600 / u["medidas"], 1) if u["medidas"] else None
+            })
+    return filas
+
+# --- HISTORIAL ---
+def _nuevo_registro(fecha, reporte, usuario):
+    ahora = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return {
+        "fecha": fecha.strftime("%Y-%m-%d"),
+        "usuario": usuario,
+        "json": json.dumps(reporte, ensure_ascii=False),
+        "creado": ahora,
+        "actualizado": ahora
+    }
+
+class DiaHistorial(dict):
+    """
+    Día del historial ('fecha', 'creado', 'actualizado'...). El 'reporte' se
+    decodifica del JSON la primera vez que se pide, no al leer el rango.
+    """
+    def __init__(self, registro):
+        super().__init__((k, v) for k, v in registro.items() if k not in ("json", "usuario"))
+        self._json = registro.get("json")
+    
+    def __missing__(self, clave):
+        if clave != "reporte" or self._json is None: raise KeyError(clave)
+        try: reporte = json.loads(self._json)
+        except (TypeError, ValueError): reporte = []
+        self["reporte"] = reporte
+        return reporte
+    
+    def get(self, clave, defecto=None):
+        try: return self[clave]
+        except KeyError: return defecto
+
+# Resultados de recuperar_historial_rango por (usuario, desde, hasta, columnas),
+# compartidos entre sesiones: cambiar de página en Historial no vuelve a leer.
+# Cada escritura del usuario descarta los rangos que contienen su fecha y un
+# cambio de revisión hecho desde fuera los descarta todos.
+TTL_RANGOS = float(leer_ajuste("historial_ttl", 300))
+MAX_RANGOS_CACHEADOS = 64
+_cache_rangos = OrderedDict()
+_generacion_historial = {}
+
+def invalidar_cache_historial(usuario, fecha_str=None):
+    u = usuario.strip().lower()
+    with _config_lock:
+        _generacion_historial[u] = _generacion_historial.get(u, 0) + 1
+        for clave in [c for c in _cache_rangos if c[0] == u]:
+            if fecha_str is None or clave[1] <= fecha_str <= clave[2]:
+                del _cache_rangos[clave]
+
+def recuperar_historial_rango(usuario, f_inicio, f_fin, columnas=None):
+    """
+    Días del rango como DiaHistorial. Con 'columnas' (p. ej. ("creado", "actualizado"))
+    solo se leen esos campos; sin "json" entre ellos no hay 'reporte'.
+    """
+    if columnas is not None: columnas = tuple(columnas)
+    u = usuario.strip().lower()
+    clave = (u, f_inicio.strftime("%Y-%m-%d"), f_fin.strftime("%Y-%m-%d"), columnas)
+    with _config_lock:
+        entrada = _cache_rangos.get(clave)
+        if entrada and entrada["expira"] > time.monotonic():
+            _cache_rangos.move_to_end(clave)
+            registros = entrada["registros"]
+        else:
+            registros = None
+            generacion = _generacion_historial.get(u, 0)
+    
+    if registros is None:
         try:
-            records = ws.get_all_records()
-        except:
+            registros = _backend().leer_historial_rango(u, clave[1], clave[2], columnas=columnas)
+        except Exception as e:
+            _backend().registrar_fallo(e)
+            print(f"Error historial rango: {e}")
             return []
+        if archivo.cubre(u, clave[1]):
+            # El rango llega a días ya archivados: se leen del disco local. Si un
+            # día está en los dos sitios (se volvió a guardar tras archivarlo)
+            # manda el de la base de datos
+            vivas = {r["fecha"] for r in registros}
+            registros = [
+                {k: v for k, v in r.items() if columnas is None or k == "fecha" or k in columnas}
+                for r in archivo.leer_rango(u, clave[1], clave[2]) if r["fecha"] not in vivas
+            ] + registros
+        with _config_lock:
+            # Si alguien escribió mientras leíamos, el resultado puede estar viejo
+            if _generacion_historial.get(u, 0) == generacion:
+                _cache_rangos[clave] = {"registros": registros, "expira": time.monotonic() + TTL_RANGOS}
+                while len(_cache_rangos) > MAX_RANGOS_CACHEADOS: _cache_rangos.popitem(last=False)
+    
+    # Objetos nuevos en cada llamada: las sesiones pueden modificar su 'reporte'
+    resultados = [DiaHistorial(r) for r in registros]
             
-        fecha_target = fecha.strftime("%Y-%m-%d")
-        encontrado = []
-        for r in records:
-            if str(r.get("Fecha")) == fecha_target:
-                try: encontrado = json.loads(r.get("JSON", "[]"))
-                except: pass
-        return encontrado
-    except: return []
-
-def eliminar_historial_por_fecha(fecha, usuario):
-    sh = conectar_google_sheets()
-    if not sh: return False
+    # Ordenamos: El más reciente primero
+    resultados.sort(key=lambda x: x["fecha"], reverse=True)
+    return resultados
+
+def upsert_historial(fecha, reporte, usuario):
+    """
+    Escribe el reporte del día en su registro existente (conservando 'Creado')
+    o lo añade si la fecha no existe, sin reescribir el resto del historial.
+    """
     try:
-        nombre_pestana = f"Historial_{usuario.strip().lower()}"
-        ws = asegurar_pestana(sh, nombre_pestana)
-        
-        fecha_target = fecha.strftime("%Y-%m-%d")
-        
-        rows = ws.get_all_values()
-        if not rows: return True
-        
-        new_rows = [rows[0]] # Encabezados
-        data_rows = rows[1:] # Datos
-        filtrados = []
-
-        for r in data_rows:
-            if len(r) > 0:
-                if str(r[0]).strip() == fecha_target:
-                    continue 
-            filtrados.append(r)
-            
-        final_rows = new_rows + filtrados
-        
-        # 3. Limpiar y reescribir
-        ws.clear()
-        ws.update(range_name="A1", values=final_rows)
-        return True
-        
+        registro = _nuevo_registro(fecha, reporte, usuario)
+        ok = _backend().upsert_historial(usuario, registro)
+        invalidar_cache_historial(usuario, registro["fecha"])
+        _publicar_revision(usuario)
+        eventos.publicar(usuario, "historial", fecha=registro["fecha"], reporte=copy.deepcopy(reporte))
+        return ok
     except Exception as e:
-        print(f"Error eliminando historial: {e}")
-        return False
\ No newline at end of file
+        _backend().registrar_fallo(e)
+        print(f"Error actualizando historial: {e}")
+        return False
+
+def recuperar_historial_por_fecha(fecha, usuario):
+    fecha_str = fecha.strftime("%Y-%m-%d")
+    try:
+        registros = _backend().leer_historial_dia(usuario, fecha_str)
+    except Exception as e:
+        _backend().registrar_fallo(e)
+        return []
+    # El archivo solo cuenta si el día ya no está vivo: manda la base de datos
+    if not registros and archivo.cubre(usuario, fecha_str):
+        registros = archivo.leer_rango(usuario, fecha_str, fecha_str)
+    
+    return _ultimo_reporte(registros)
+
+def _ultimo_reporte(registros):
+    # Si hay duplicados nos quedamos con el último, como siempre
+    encontrado = []
+    for r in registros:
+        try: encontrado = json.loads(r["json"])
+        except: pass
+    return encontrado
+
+# --- RETENCIÓN ---
+# Los días de más de RETENCION_MESES meses (contando desde el mes actual) se
+# pasan al archivo local (ver archivo.py) una vez al día por usuario, en
+# segundo plano. 0 = desactivado.
+RETENCION_MESES = int(leer_ajuste("historial_retencion_meses", 0))
+_archivados = {}  # usuario -> día de la última pasada
+
+def _corte_retencion(meses):
+    """Primer día del mes de hace 'meses' meses: lo anterior se archiva."""
+    hoy = datetime.now()
+    a, m = divmod(hoy.year * 12 + hoy.month - 1 - meses, 12)
+    return f"{a:04d}-{m + 1:02d}-01"
+
+def archivar_historial(usuario, meses=None):
+    """
+    Mueve al archivo los días anteriores al corte de retención. Primero se
+    escribe el archivo y solo después se borra de la base de datos.
+    Devuelve {"corte", "filas", "bytes"} o None si falla.
+    """
+    u = usuario.strip().lower()
+    corte = _corte_retencion(RETENCION_MESES if meses is None else meses)
+    with _lock_de(_cargas_config, ("archivo", u)):
+        try:
+            registros = _backend().leer_historial_anterior(u, corte)
+            if not registros: return {"corte": corte, "filas": 0, "bytes": 0}
+            escritos = archivo.archivar(u, registros)
+            # Solo lo que se archivó tal cual: un día editado mientras tanto se queda
+            _backend().eliminar_historial_anterior(u, [(r["fecha"], r["actualizado"]) for r in registros])
+        except Exception as e:
+            _backend().registrar_fallo(e)
+            print(f"Error archivando historial: {e}")
+            return None
+    
+    invalidar_cache_historial(u)
+    _publicar_revision(u)
+    print(f"🗄️ Archivados {len(registros)} días de {u} anteriores a {corte}")
+    return {"corte": corte, "filas": len(registros), "bytes": escritos}
+
+def programar_archivado(usuario):
+    """Lanza la pasada de retención del usuario si hoy aún no se hizo."""
+    if RETENCION_MESES <= 0: return
+    u = usuario.strip().lower()
+    hoy = datetime.now().date()
+    with _config_lock:
+        if _archivados.get(u) == hoy: return
+        _archivados[u] = hoy
+    
+    def tarea():
+        with prioridad(FONDO): archivar_historial(u)
+    threading.Thread(target=tarea, name=f"archivo-{u}", daemon=True).start()
+
+# --- MANTENIMIENTO ---
+def compactar_historial(usuario):
+    """
+    Quita los días duplicados del historial del usuario (se queda el último
+    editado, con su 'Creado' original) y lo deja ordenado por fecha.
+    Devuelve {"filas", "bytes"} recuperados o None si falla.
+    """
+    u = usuario.strip().lower()
+    with _lock_de(_cargas_config, ("archivo", u)):
+        try:
+            r = _backend().compactar_historial(u)
+        except Exception as e:
+            _backend().registrar_fallo(e)
+            print(f"Error compactando historial: {e}")
+            return None
+    
+    invalidar_cache_historial(u)
+    _publicar_revision(u)
+    return {
+        **r,
+        "filas": r["filas_antes"] - r["filas_despues"],
+        "bytes": r["bytes_antes"] - r["bytes_despues"]
+    }
+
+# --- ARRANQUE ---
+def cargar_inicio_db(usuario, fecha):
+    """
+    Config y reporte del día para la primera pantalla, devueltos como
+    (datos, reporte). Si la config no está en caché todo sale de una sola
+    lectura del backend, que además deja al día el taller y la revisión.
+    """
+    u = usuario.strip().lower()
+    with _lock_de(_cargas_config, u):
+        if _config_cacheada(u) is None:
+            estado = _estado_taller(u, refrescar=False)
+            try:
+                with estado["lock"]:
+                    inicio = _backend().leer_inicio(u, fecha.strftime("%Y-%m-%d"), estado["n"])
+                    for ev in inicio["eventos_taller"]: _aplicar_evento(estado, ev)
+            except ConnectionError: return {}, []
+            except Exception as e:
+                _backend().registrar_fallo(e)
+                print(f"Error en la carga inicial: {e}")
+                inicio = None
+            
+            if inicio is not None:
+                with _config_lock: _stats_cache_config["fallos"] += 1
+                config_dict = inicio["config"]
+                _recordar_config(u, config_dict.items())
+                _marcar_revision(u, config_dict.get("Revision", ""))
+                datos = _config_desde_dict(config_dict)
+                datos["averiadas"] = averiadas_taller(u, refrescar=False)
+                _cachear_config(u, datos)
+                return datos, _ultimo_reporte(inicio["historial"])
+    
+    # Config ya cacheada por otra sesión (o falló la lectura conjunta): por separado
+    return cargar_datos_db(u), recuperar_historial_por_fecha(fecha, u)
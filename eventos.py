@@ -0,0 +1,66 @@
+"""
+Bus de eventos en memoria, por usuario.
+
+Las escrituras publican un evento ('config', 'taller', 'historial') y cada
+sesión de Streamlit suscrita del mismo usuario lo recibe en su buzón. La sesión
+lo consume en su siguiente ciclo y actualiza solo las claves afectadas, sin
+volver a leer la base de datos. Solo cubre las sesiones de este proceso; los
+cambios hechos desde otros servidores los detecta la marca de revisión.
+"""
+import threading
+import time
+from collections import deque
+
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+MAX_EVENTOS_BUZON = 100
+# Una sesión que no consume su buzón en este tiempo se da por cerrada
+SEGUNDOS_SESION_INACTIVA = 600
+
+_lock = threading.Lock()
+_suscriptores = {}  # usuario -> {id_sesion: {"buzon": deque, "visto": t}}
+
+def sesion_actual():
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else None
+
+def suscribir(usuario, id_sesion):
+    if not id_sesion: return
+    with _lock:
+        subs = _suscriptores.setdefault(usuario.strip().lower(), {})
+        if id_sesion not in subs:
+            subs[id_sesion] = {"buzon": deque(maxlen=MAX_EVENTOS_BUZON), "visto": time.monotonic()}
+
+def desuscribir(usuario, id_sesion):
+    with _lock:
+        _suscriptores.get(usuario.strip().lower(), {}).pop(id_sesion, None)
+
+def publicar(usuario, tipo, **datos):
+    """Entrega el evento a las demás sesiones del usuario (no a la que escribe)."""
+    origen = sesion_actual()
+    evento = {"tipo": tipo, "momento": time.time(), **datos}
+    ahora = time.monotonic()
+    with _lock:
+        subs = _suscriptores.get(usuario.strip().lower(), {})
+        for id_sesion in [i for i, s in subs.items() if ahora - s["visto"] > SEGUNDOS_SESION_INACTIVA]:
+            del subs[id_sesion]
+        for id_sesion, s in subs.items():
+            if id_sesion != origen: s["buzon"].append(evento)
+
+def recibir(usuario, id_sesion):
+    """Vacía y devuelve el buzón de la sesión."""
+    with _lock:
+        s = _suscriptores.get(usuario.strip().lower(), {}).get(id_sesion)
+        if s is None: return []
+        s["visto"] = time.monotonic()
+        eventos = list(s["buzon"])
+        s["buzon"].clear()
+        return eventos
+
+def estadisticas():
+    with _lock:
+        return {
+            "usuarios": len(_suscriptores),
+            "sesiones": sum(len(s) for s in _suscriptores.values()),
+            "en_espera": sum(len(x["buzon"]) for s in _suscriptores.values() for x in s.values())
+        }
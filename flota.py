@@ -0,0 +1,53 @@
+"""
+Índice compacto de la flota.
+
+Los conjuntos de unidades (flota, taller, asignadas...) se representan como
+máscaras de bits en un int: la unidad N es el bit N. Pertenencia, uniones,
+intersecciones y diferencias cuestan una operación, y la flota se construye
+directamente desde los rangos sin expandirlos en listas. El índice se calcula
+una vez por versión de la config (rangos + averiadas) y se reutiliza.
+"""
+from functools import lru_cache
+
+def mascara(unidades):
+    m = 0
+    for u in unidades:
+        m |= 1 << int(u)
+    return m
+
+def mascara_rangos(rangos):
+    m = 0
+    for a, b in rangos:
+        a, b = int(a), int(b)
+        if a > b: a, b = b, a
+        m |= (1 << (b + 1)) - (1 << a)
+    return m
+
+def unidades(m):
+    """Lista ordenada de las unidades presentes en la máscara."""
+    bits = bin(m)[:1:-1]
+    return [i for i, c in enumerate(bits) if c == "1"]
+
+def contiene(m, u):
+    return (m >> int(u)) & 1 == 1
+
+def contar(m):
+    return m.bit_count()
+
+@lru_cache(maxsize=128)
+def _indice(rangos, averiadas):
+    flota = mascara_rangos(rangos)
+    taller = mascara(averiadas) & flota
+    operativas = flota & ~taller
+    return {
+        "flota": flota,
+        "taller": taller,
+        "operativas": operativas,
+        "lista": tuple(unidades(flota)),
+    }
+
+def indice_flota(datos):
+    """Índice de la config dada (cacheado por rangos y averiadas)."""
+    rangos = tuple((int(r[0]), int(r[1])) for r in datos.get("rangos", []))
+    averiadas = tuple(sorted(set(int(u) for u in datos.get("averiadas", []))))
+    return _indice(rangos, averiadas)
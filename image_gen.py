@@ -1,41 +1,48 @@
 import os
 import re
-import requests
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 from io import BytesIO
 from PIL import Image, ImageDraw, ImageFont
 import streamlit as st
 
+from almacenamiento import leer_ajuste
+
 # --- RUTAS ABSOLUTAS LOCALES ---
 # Esto buscará las fuentes en la misma carpeta donde está este script
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 FONT_REGULAR = os.path.join(BASE_DIR, "Roboto-Regular.ttf")
 FONT_BOLD = os.path.join(BASE_DIR, "Roboto-Bold.ttf")
+# El icono va en el repositorio: el render nunca sale a internet
 ICONO_BOMBA = os.path.join(BASE_DIR, "icono_bomba.png")
 
 @st.cache_resource
 def obtener_icono_local():
-    """Descarga el icono si no existe, o lo carga desde el disco."""
-    img_icon = None
-    url_icon = "https://cdnjs.cloudflare.com/ajax/libs/twemoji/14.0.2/72x72/26fd.png"
-    
-    if not os.path.exists(ICONO_BOMBA):
-        try:
-            r = requests.get(url_icon, headers={'User-Agent': 'Mozilla/5.0'}, timeout=10)
-            if r.status_code == 200:
-                with open(ICONO_BOMBA, 'wb') as f:
-                    f.write(r.content)
-        except: pass
-        
-    if os.path.exists(ICONO_BOMBA):
-        try:
-            img_icon = Image.open(ICONO_BOMBA).convert("RGBA")
-            img_icon = img_icon.resize((40, 40))
-        except: pass
-        
-    return img_icon
+    """Carga el icono empaquetado; si falta, las imágenes salen sin iconos."""
+    try:
+        return Image.open(ICONO_BOMBA).convert("RGBA").resize((40, 40))
+    except Exception as e:
+        print(f"⚠️ No se pudo cargar el icono {ICONO_BOMBA}: {e}")
+        return None
+
+# --- CACHÉ DE RECURSOS ---
+# Fuentes por (ruta, tamaño) e iconos ya redimensionados por (ruta, tamaño),
+# compartidos por todas las sesiones. La vista previa de Configuración
+# regenera la imagen con cada cambio y sin esto reparsea el TTF cada vez.
+MAX_FUENTES = 32
+MAX_ICONOS = 16
+# Anchos de palabra por (fuente, palabra): los números de unidad se repiten mucho
+MAX_AVANCES = 8192
 
 def cargar_fuente_local(ruta_fuente, tamaño):
-    """Carga la fuente directamente desde el archivo local."""
+    """Carga la fuente directamente desde el archivo local (cacheada)."""
+    return _fuente(ruta_fuente, int(tamaño))
+
+@lru_cache(maxsize=MAX_FUENTES)
+def _fuente(ruta_fuente, tamaño):
     if not os.path.exists(ruta_fuente):
         print(f"⚠️ ERROR: No se encontró el archivo {ruta_fuente}. Asegúrate de subirlo al servidor.")
         return ImageFont.load_default()
@@ -46,13 +53,96 @@ def cargar_fuente_local(ruta_fuente, tamaño):
         print(f"⚠️ Error cargando {ruta_fuente}: {e}")
         return ImageFont.load_default()
 
+@lru_cache(maxsize=MAX_ICONOS)
+def _sprite_icono(ruta_icono, tamaño):
+    """Icono en RGBA al tamaño pedido, o None si no hay icono."""
+    base = obtener_icono_local() if ruta_icono == ICONO_BOMBA else None
+    return base.resize((tamaño, tamaño)) if base is not None else None
+
+def estadisticas_recursos():
+    """Aciertos, fallos y tasa de acierto de las cachés de fuentes e iconos."""
+    res = {}
+    for nombre, cache in (("fuentes", _fuente), ("iconos", _sprite_icono), ("avances", _avance)):
+        info = cache.cache_info()
+        total = info.hits + info.misses
+        res[nombre] = {
+            "aciertos": info.hits, "fallos": info.misses,
+            "tamaño": info.currsize, "maximo": info.maxsize,
+            "tasa_aciertos": (info.hits / total) if total else None
+        }
+    return res
+
+# Tamaño de letra por defecto: sus fuentes e icono se preparan al arrancar
+TAMAÑOS_COMUNES = (24,)
+
+@st.cache_resource
+def preparar_recursos(tamaños=TAMAÑOS_COMUNES):
+    """
+    Verifica una vez por proceso que las fuentes y el icono empaquetados
+    existen y se pueden abrir, y deja en caché los tamaños más usados.
+    Devuelve la lista de problemas encontrados (vacía si todo está bien).
+    """
+    problemas = []
+    for ruta in (FONT_REGULAR, FONT_BOLD):
+        try: ImageFont.truetype(ruta, 12)
+        except Exception as e: problemas.append(f"Fuente {os.path.basename(ruta)}: {e}")
+    if obtener_icono_local() is None:
+        problemas.append(f"Icono {os.path.basename(ICONO_BOMBA)} no disponible")
+    
+    for t in tamaños:
+        # Los mismos que pide generar_imagen_en_memoria
+        cargar_fuente_local(FONT_BOLD, t + 4)
+        cargar_fuente_local(FONT_BOLD, t)
+        cargar_fuente_local(FONT_REGULAR, t)
+        _sprite_icono(ICONO_BOMBA, int(t * 1.5))
+    
+    for p in problemas: print(f"⚠️ Recursos de imagen: {p}")
+    return problemas
+
 def limpiar_texto(texto):
     # Se mantienen los caracteres válidos, incluyendo tildes y eñes
     return re.sub(r'[^\w\s\.,:;\-\(\)\/áéíóúÁÉÍÓÚñÑ]', '', str(texto))
 
-def generar_imagen_en_memoria(reporte_lista, fecha_dt, rango_txt, config_datos):
-    icon_res = obtener_icono_local()
-    
+# --- MAQUETACIÓN EN DOS PASADAS ---
+# Primero se calcula la maqueta (cajas, textos e iconos ya posicionados y el
+# alto total) midiendo con las fuentes, sin lienzo; después se pinta en un
+# lienzo del alto exacto. Ni se reserva memoria de más ni se corta un reporte
+# largo.
+
+def _medir(fnt, txt):
+    """Caja del texto dibujado en (0, 0), como d.textbbox."""
+    return fnt.getbbox(txt)
+
+@lru_cache(maxsize=MAX_AVANCES)
+def _avance(fnt, palabra):
+    return fnt.getlength(palabra)
+
+def _partir_lineas(texto, fnt, ancho_max, aislar_largas=False):
+    """
+    Reparte las palabras en líneas de hasta ancho_max px y devuelve
+    [(línea, ancho)]. Cada palabra se mide una vez (con caché), así que el
+    coste es lineal en palabras. Como siempre, la línea cuenta con un espacio
+    al final. Con aislar_largas, una palabra más ancha que la línea va sola.
+    """
+    espacio = _avance(fnt, " ")
+    lineas, actual, ancho = [], [], 0.0
+    for w in texto.split():
+        aw = _avance(fnt, w)
+        if aislar_largas and aw > ancho_max:
+            if actual: lineas.append((" ".join(actual), ancho - espacio))
+            lineas.append((w, aw))
+            actual, ancho = [], 0.0
+            continue
+        if actual and ancho + aw + espacio > ancho_max:
+            lineas.append((" ".join(actual), ancho - espacio))
+            actual, ancho = [], 0.0
+        actual.append(w)
+        ancho += aw + espacio
+    if actual: lineas.append((" ".join(actual), ancho - espacio))
+    return lineas
+
+def _maquetar(reporte_lista, fecha_dt, rango_txt, config_datos):
+    """Primera pasada: primitivas posicionadas y tamaño del lienzo."""
     ANCHO = config_datos.get("img_width", 450)
     FONT_S = config_datos.get("font_size", 24)
     BG = config_datos.get("bg_color", "#ECE5DD")
@@ -68,8 +158,7 @@ def generar_imagen_en_memoria(reporte_lista, fecha_dt, rango_txt, config_datos):
     f_bd = cargar_fuente_local(FONT_BOLD, FONT_S)
     f_no = cargar_fuente_local(FONT_REGULAR, FONT_S)
 
-    img = Image.new('RGB', (ANCHO, 3000), color=BG)
-    d = ImageDraw.Draw(img)
+    prims = []  # ("caja", [(x0, y0), (x1, y1)], color) | ("texto", (x, y), txt, fuente, color) | ("icono", (x, y), sprite)
     y = 40
     w_draw = ANCHO - 40
 
@@ -77,37 +166,10 @@ def generar_imagen_en_memoria(reporte_lista, fecha_dt, rango_txt, config_datos):
         if not txt: return y_pos
         txt = limpiar_texto(str(txt)).upper()
         
-        lines = []
-        cur = ""
-        words = txt.split()
-        
-        for w in words:
-            bbox = d.textbbox((0,0), w, font=fnt)
-            w_word = bbox[2] - bbox[0]
-            
-            if w_word > w_draw:
-                if cur: lines.append(cur)
-                lines.append(w)
-                cur = ""
-                continue
-
-            bbox_line = d.textbbox((0,0), cur + w + " ", font=fnt)
-            if (bbox_line[2] - bbox_line[0]) > w_draw:
-                lines.append(cur)
-                cur = w + " "
-            else:
-                cur += w + " "
-        if cur: lines.append(cur)
-        
-        for l in lines:
-            l = l.strip()
-            if not l: continue
-            bb = d.textbbox((0,0), l, font=fnt)
-            w_l = bb[2] - bb[0]
-            
+        for l, w_l in _partir_lineas(txt, fnt, w_draw, aislar_largas=True):
             x_start = (ANCHO - w_l) / 2
-            d.rectangle([(x_start - 5, y_pos), (x_start + w_l + 5, y_pos + LH + 2)], fill=bg_col)
-            d.text((x_start, y_pos), l, font=fnt, fill=TXT_COL)
+            prims.append(("caja", [(x_start - 5, y_pos), (x_start + w_l + 5, y_pos + LH + 2)], bg_col))
+            prims.append(("texto", (x_start, y_pos), l, fnt, TXT_COL))
             y_pos += int(LH * 1.3)
         return y_pos + 8
 
@@ -119,20 +181,18 @@ def generar_imagen_en_memoria(reporte_lista, fecha_dt, rango_txt, config_datos):
     y = draw_centered("REPORTE DE ESTACIONES DE", y, f_ti, col_ti)
     y = draw_centered(f"SERVICIO Y UNIDADES {f_str}", y, f_ti, col_ti)
     
-    if icon_res:
-        isz = int(FONT_S * 1.5)
-        try:
-            icon_draw = icon_res.resize((isz, isz))
-            cnt = 5
+    isz = int(FONT_S * 1.5)
+    icon_draw = _sprite_icono(ICONO_BOMBA, isz)
+    if icon_draw is not None:
+        cnt = 5
+        tot_w = (isz*cnt) + (8*(cnt-1))
+        if tot_w > w_draw: 
+            cnt = 3
             tot_w = (isz*cnt) + (8*(cnt-1))
-            if tot_w > w_draw: 
-                cnt = 3
-                tot_w = (isz*cnt) + (8*(cnt-1))
-            sx = (ANCHO - tot_w)/2
-            for i in range(cnt):
-                img.paste(icon_draw, (int(sx + i*(isz+8)), y), icon_draw)
-            y += int(isz * 1.5)
-        except: y += LH
+        sx = (ANCHO - tot_w)/2
+        for i in range(cnt):
+            prims.append(("icono", (int(sx + i*(isz+8)), y), icon_draw))
+        y += int(isz * 1.5)
     else:
         y += LH
 
@@ -143,65 +203,160 @@ def generar_imagen_en_memoria(reporte_lista, fecha_dt, rango_txt, config_datos):
         
         txt_st = f"• ESTACIÓN {nom}: {hor}" if hor else f"• ESTACIÓN {nom}"
             
-        lines_t = []
-        cur_t = ""
-        for w in txt_st.split():
-            if d.textbbox((0,0), cur_t + w + " ", font=f_bd)[2] > w_draw:
-                lines_t.append(cur_t)
-                cur_t = w + " "
-            else:
-                cur_t += w + " "
-        if cur_t: lines_t.append(cur_t)
-        
-        for l in lines_t:
-            bb = d.textbbox((0,0), l, font=f_bd)
-            w_l = bb[2] - bb[0]
-            d.rectangle([(20, y), (20 + w_l + 10, y + LH + 4)], fill=col)
-            d.text((25, y + 2), l, font=f_bd, fill=TXT_COL)
+        espacio_bd = _avance(f_bd, " ")
+        for l, w_l in _partir_lineas(txt_st, f_bd, w_draw):
+            # La caja incluye el espacio final, como cuando se medía la línea con él
+            w_l += espacio_bd
+            prims.append(("caja", [(20, y), (20 + w_l + 10, y + LH + 4)], col))
+            prims.append(("texto", (25, y + 2), l, f_bd, TXT_COL))
             y += int(LH * 1.2)
         
         nums = " ".join([f"{u:02d}" for u in st_data['unidades']])
-        lines_n = []
-        cur_n = ""
-        for w in nums.split():
-            if d.textbbox((0,0), cur_n + w + " ", font=f_no)[2] > w_draw:
-                lines_n.append(cur_n)
-                cur_n = w + " "
-            else:
-                cur_n += w + " "
-        if cur_n: lines_n.append(cur_n)
-        
-        for l in lines_n:
-            d.text((20, y), l, font=f_no, fill=TXT_COL)
+        for l, _ in _partir_lineas(nums, f_no, w_draw):
+            prims.append(("texto", (20, y), l, f_no, TXT_COL))
             y += LH
         y += GAP
 
     if rango_txt:
         txt_r = "• RANGO DE UNIDADES"
-        bb_r = d.textbbox((0,0), txt_r, font=f_bd)
+        bb_r = _medir(f_bd, txt_r)
         w_r = bb_r[2] - bb_r[0]
-        d.rectangle([(20, y), (20 + w_r + 10, y + LH + 4)], fill="#cff4fc")
-        d.text((25, y + 2), txt_r, font=f_bd, fill=TXT_COL)
+        prims.append(("caja", [(20, y), (20 + w_r + 10, y + LH + 4)], "#cff4fc"))
+        prims.append(("texto", (25, y + 2), txt_r, f_bd, TXT_COL))
         y += int(LH * 1.2)
         
         ran_clean = limpiar_texto(rango_txt).upper()
-        lines_r = []
-        cur_r = ""
-        for w in ran_clean.split():
-            if d.textbbox((0,0), cur_r + w + " ", font=f_no)[2] > w_draw:
-                lines_r.append(cur_r)
-                cur_r = w + " "
-            else:
-                cur_r += w + " "
-        if cur_r: lines_r.append(cur_r)
-        
-        for l in lines_r:
-            d.text((20, y), l, font=f_no, fill=TXT_COL)
+        for l, _ in _partir_lineas(ran_clean, f_no, w_draw):
+            prims.append(("texto", (20, y), l, f_no, TXT_COL))
             y += LH
         y += GAP
 
-    out = img.crop((0, 0, ANCHO, y + 20))
-    buf = BytesIO()
-    out.save(buf, "PNG")
-    buf.seek(0)
-    return buf
+    return {"ancho": ANCHO, "alto": y + 20, "fondo": BG, "primitivas": prims}
+
+def _rasterizar(maqueta):
+    """Segunda pasada: pinta la maqueta en un lienzo de su tamaño exacto."""
+    img = Image.new('RGB', (maqueta["ancho"], maqueta["alto"]), color=maqueta["fondo"])
+    d = ImageDraw.Draw(img)
+    for p in maqueta["primitivas"]:
+        if p[0] == "caja": d.rectangle(p[1], fill=p[2])
+        elif p[0] == "texto": d.text(p[1], p[2], font=p[3], fill=p[4])
+        elif p[0] == "icono": img.paste(p[2], p[1], p[2])
+    return img
+
+# --- CACHÉ DE IMÁGENES ---
+# El PNG se guarda por el hash de todo lo que influye en él (reporte, fecha,
+# texto del pie y apariencia). Dos niveles, ambos LRU acotados por bytes: en
+# memoria y en disco (sobrevive a reinicios). Volver a guardar el mismo día,
+# reabrirlo desde Historial o que dos usuarios exporten lo mismo no repinta.
+# Subir VERSION_RENDER al cambiar el dibujo invalida lo guardado.
+VERSION_RENDER = 1
+CLAVES_APARIENCIA = ("img_width", "font_size", "bg_color", "text_color", "st_colors")
+MAX_BYTES_MEMORIA = int(float(leer_ajuste("render_cache_mb", 32)) * 1024 * 1024)
+MAX_BYTES_DISCO = int(float(leer_ajuste("render_cache_disco_mb", 256)) * 1024 * 1024)
+RUTA_CACHE_RENDER = leer_ajuste("render_cache_ruta", os.path.join(BASE_DIR, "cache_render"))
+
+_render_lock = threading.Lock()
+_render_memoria = OrderedDict()  # clave -> bytes PNG
+_render_disco = None             # clave -> tamaño, en orden de uso (se carga al primer uso)
+_render_stats = {"memoria": 0, "disco": 0, "fallos": 0, "bytes_memoria": 0, "bytes_disco": 0}
+
+def clave_render(reporte_lista, fecha_dt, rango_txt, config_datos):
+    contenido = {
+        "v": VERSION_RENDER,
+        "reporte": reporte_lista,
+        "fecha": fecha_dt.strftime("%Y-%m-%d"),
+        "rango": rango_txt or "",
+        "apariencia": {k: config_datos.get(k) for k in CLAVES_APARIENCIA},
+    }
+    texto = json.dumps(contenido, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+def _ruta_render(clave):
+    return os.path.join(RUTA_CACHE_RENDER, f"{clave}.png")
+
+def _indice_disco():
+    """Ficheros del nivel de disco, del menos al más recientemente usado."""
+    global _render_disco
+    if _render_disco is None:
+        _render_disco = OrderedDict()
+        try:
+            entradas = [e for e in os.scandir(RUTA_CACHE_RENDER) if e.name.endswith(".png")]
+        except FileNotFoundError:
+            entradas = []
+        for e in sorted(entradas, key=lambda e: e.stat().st_mtime):
+            _render_disco[e.name[:-4]] = e.stat().st_size
+        _render_stats["bytes_disco"] = sum(_render_disco.values())
+    return _render_disco
+
+def _guardar_memoria(clave, png):
+    # Dos sesiones pueden fallar a la vez con la misma clave: se resta la que había
+    _render_stats["bytes_memoria"] += len(png) - len(_render_memoria.pop(clave, b""))
+    _render_memoria[clave] = png
+    while _render_stats["bytes_memoria"] > MAX_BYTES_MEMORIA and len(_render_memoria) > 1:
+        _, viejo = _render_memoria.popitem(last=False)
+        _render_stats["bytes_memoria"] -= len(viejo)
+
+def _guardar_disco(clave, png):
+    disco = _indice_disco()
+    try:
+        os.makedirs(RUTA_CACHE_RENDER, exist_ok=True)
+        ruta = _ruta_render(clave)
+        with open(ruta + ".tmp", "wb") as f: f.write(png)
+        os.replace(ruta + ".tmp", ruta)
+    except OSError as e:
+        print(f"⚠️ No se pudo guardar la imagen en caché: {e}")
+        return
+    _render_stats["bytes_disco"] += len(png) - disco.pop(clave, 0)
+    disco[clave] = len(png)
+    while _render_stats["bytes_disco"] > MAX_BYTES_DISCO and len(disco) > 1:
+        viejo, tam = disco.popitem(last=False)
+        _render_stats["bytes_disco"] -= tam
+        try: os.remove(_ruta_render(viejo))
+        except OSError: pass
+
+def _buscar_render(clave):
+    with _render_lock:
+        png = _render_memoria.get(clave)
+        if png is not None:
+            _render_memoria.move_to_end(clave)
+            _render_stats["memoria"] += 1
+            return png
+        disco = _indice_disco()
+        if clave in disco:
+            try:
+                with open(_ruta_render(clave), "rb") as f: png = f.read()
+                os.utime(_ruta_render(clave))
+            except OSError:
+                _render_stats["bytes_disco"] -= disco.pop(clave)
+                png = None
+        if png is not None:
+            disco.move_to_end(clave)
+            _render_stats["disco"] += 1
+            _guardar_memoria(clave, png)
+            return png
+        _render_stats["fallos"] += 1
+        return None
+
+def estadisticas_cache_render():
+    with _render_lock:
+        total = _render_stats["memoria"] + _render_stats["disco"] + _render_stats["fallos"]
+        return {
+            **_render_stats,
+            "imagenes_memoria": len(_render_memoria),
+            "imagenes_disco": len(_render_disco or {}),
+            "tasa_aciertos": ((_render_stats["memoria"] + _render_stats["disco"]) / total) if total else None
+        }
+
+def generar_imagen_en_memoria(reporte_lista, fecha_dt, rango_txt, config_datos):
+    clave = clave_render(reporte_lista, fecha_dt, rango_txt, config_datos)
+    png = _buscar_render(clave)
+    if png is None:
+        img = _rasterizar(_maquetar(reporte_lista, fecha_dt, rango_txt, config_datos))
+        buf = BytesIO()
+        img.save(buf, "PNG")
+        png = buf.getvalue()
+        with _render_lock:
+            _guardar_memoria(clave, png)
+            _guardar_disco(clave, png)
+    # Un BytesIO propio por llamada: quien lo reciba puede leerlo y moverlo
+    return BytesIO(png)
@@ -3,13 +3,53 @@ import time
 import sys
 import os
 import streamlit.components.v1 as components 
+from datetime import datetime
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from utils import inyectar_css, verificar_login, verificar_fase_cierre, mostrar_bus_loading
-from database import cargar_datos_db, recuperar_historial_por_fecha
-from image_gen import generar_imagen_en_memoria
+from database import cargar_datos_db, cargar_inicio_db, recuperar_historial_por_fecha, revision_datos, programar_archivado
+from image_gen import generar_imagen_en_memoria, preparar_recursos
 from views import asignacion, taller, configuracion, historial
+import eventos
+
+# --- MODO VIVO ---
+# Cada 10 s solo se consulta la marca de revisión (compartida entre sesiones);
+# la config se recarga únicamente si cambió. Corre como fragmento, sin bloquear.
+@st.fragment(run_every=10)
+def vigilar_cambios(usuario):
+    rev = revision_datos(usuario)
+    if rev != st.session_state.get("revision_datos"):
+        st.session_state.revision_datos = rev
+        if 'datos_app' in st.session_state: del st.session_state['datos_app']
+        st.rerun(scope="app")
+    st.caption(f"📡 Sincronizado {time.strftime('%H:%M:%S')}")
+
+# --- EVENTOS DE OTRAS SESIONES ---
+# Las escrituras de otras pestañas/dispositivos del mismo usuario llegan por el
+# bus en memoria: se aplican solo las claves afectadas, sin leer la base.
+def aplicar_eventos(lista, usuario):
+    cambiado = False
+    d = st.session_state.get("datos_app")
+    for ev in lista:
+        if ev["tipo"] == "config" and d is not None:
+            for k, v in ev["datos"].items():
+                if d.get(k) != v: d[k] = v; cambiado = True
+        elif ev["tipo"] == "taller" and d is not None:
+            if d.get("averiadas") != ev["averiadas"]: d["averiadas"] = ev["averiadas"]; cambiado = True
+        elif ev["tipo"] == "historial":
+            clave = f"db_hist_{ev['fecha'].replace('-', '')}_{usuario}"
+            if clave in st.session_state and st.session_state[clave] != ev["reporte"]:
+                st.session_state[clave] = ev["reporte"]; cambiado = True
+    return cambiado
+
+@st.fragment(run_every=3)
+def escuchar_eventos(usuario):
+    recibidos = eventos.recibir(usuario, eventos.sesion_actual())
+    if recibidos and aplicar_eventos(recibidos, usuario):
+        # Ya estamos al día con lo que publicaron: no hace falta que el Modo Vivo recargue
+        st.session_state.revision_datos = revision_datos(usuario)
+        st.rerun(scope="app")
 
 # 1. Configuración
 st.set_page_config(
@@ -22,6 +62,9 @@ st.set_page_config(
 # 2. Verificar cierre
 verificar_fase_cierre()
 
+# 3. Fuentes e icono empaquetados (una vez por proceso, sin red)
+preparar_recursos()
+
 # 4. Estilos y Auth
 inyectar_css()
 is_authenticated, cookie_manager = verificar_login()
@@ -54,12 +97,28 @@ if is_authenticated:
     
     def cambiar_vista(nueva_vista): st.session_state.vista_actual = nueva_vista
 
+    if 'datos_app' not in st.session_state and not st.session_state.get("inicio_cargado"):
+        # Primera carga de la sesión: config y reporte de hoy en una sola lectura.
+        # La revisión viene en la misma config, así que no hace falta pedirla antes.
+        hoy = datetime.now()
+        st.session_state.datos_app, reporte_hoy = cargar_inicio_db(usuario_actual, hoy)
+        if st.session_state.datos_app:
+            st.session_state[f"db_hist_{hoy.strftime('%Y%m%d')}_{usuario_actual}"] = reporte_hoy
+        st.session_state.revision_datos = revision_datos(usuario_actual)
+        st.session_state.inicio_cargado = True
+        programar_archivado(usuario_actual)
+    
     if 'datos_app' not in st.session_state:
+        # La revisión se toma antes de cargar: un cambio intermedio provocará otra recarga
+        st.session_state.revision_datos = revision_datos(usuario_actual)
         st.session_state.datos_app = cargar_datos_db(usuario_actual)
-        if "rangos" not in st.session_state.datos_app: st.session_state.datos_app["rangos"] = [[1, 100]]
+    if "rangos" not in st.session_state.datos_app: st.session_state.datos_app["rangos"] = [[1, 100]]
 
     if 'reporte_diario' not in st.session_state: st.session_state.reporte_diario = [] 
 
+    eventos.suscribir(usuario_actual, eventos.sesion_actual())
+    escuchar_eventos(usuario_actual)
+
     # --- SIDEBAR ---
     with st.sidebar:
         st.header("Panel de Control")
@@ -74,6 +133,7 @@ if is_authenticated:
         st.divider()
         st.write("🔄 **Sincronización**")
         modo_vivo = st.toggle("📡 Modo Vivo", value=False)
+        if modo_vivo: vigilar_cambios(usuario_actual)
         
         if st.button("🔄 Recargar Manual", use_container_width=True):
             if 'datos_app' in st.session_state: del st.session_state['datos_app']
@@ -94,11 +154,6 @@ if is_authenticated:
     elif st.session_state.vista_actual == "Historial": historial.render_vista(usuario_actual)
     elif st.session_state.vista_actual == "Configuracion": configuracion.render_vista(usuario_actual)
 
-    if modo_vivo:
-        time.sleep(10)
-        if 'datos_app' in st.session_state: del st.session_state['datos_app']
-        st.rerun()
-
     # --- PASO 3: SECUENCIA DE REVELADO Y CIERRE ---
     if debe_mostrar_loader:
         
@@ -1,4 +1,5 @@
 import streamlit as st
+import re
 import pyotp
 import qrcode
 import time
@@ -7,6 +8,7 @@ from datetime import datetime, timedelta
 import extra_streamlit_components as stx
 import streamlit.components.v1 as components # Necesario para el truco de JS
 from database import validar_usuario_db, registrar_usuario_con_totp, restablecer_con_totp
+from flota import mascara_rangos, contar
 
 def inyectar_css():
     st.markdown("""
@@ -256,6 +258,39 @@ def obtener_lista_horas_puntuales():
         horas.append(t)
     return horas
 
+def parsear_expresion_unidades(texto, flota):
+    """
+    Convierte "1-10, 15, 20 - 25" en la máscara de las unidades que están en
+    la flota (ver flota.py). Los rangos se recortan a la flota antes de
+    expandirse, así "1-999999999" cuesta lo mismo que "1-10".
+    Devuelve (mascara, fuera, errores): cuántas unidades pedidas no existen y
+    los fragmentos que no se entendieron.
+    """
+    maxima = flota.bit_length() - 1
+    pedidas, sobrantes, errores = 0, [], []
+    texto = re.sub(r'\s*-\s*', '-', str(texto or ""))
+    for parte in re.split(r'[,;\s]+', texto):
+        if not parte: continue
+        m = re.fullmatch(r'(\d+)-(\d+)', parte)
+        if m:
+            a, b = int(m.group(1)), int(m.group(2))
+        elif parte.isdigit():
+            a = b = int(parte)
+        else:
+            errores.append(parte)
+            continue
+        if a > b: a, b = b, a
+        if a <= maxima: pedidas |= mascara_rangos([(a, min(b, maxima))])
+        if b > maxima: sobrantes.append((max(a, maxima + 1), b))
+    
+    # Lo que pasa del final de la flota se cuenta por intervalos, sin expandir
+    fuera, hasta = contar(pedidas & ~flota), maxima
+    for a, b in sorted(sobrantes):
+        if b > hasta:
+            fuera += b - max(a, hasta + 1) + 1
+            hasta = b
+    return pedidas & flota, fuera, errores
+
 def selector_de_rangos(pool_unidades, key_unico, default_str=None):
     if not pool_unidades:
         st.info("No hay unidades disponibles.")
@@ -1,26 +1,39 @@
 import streamlit as st
 import base64
 import urllib.parse
-import threading
 from datetime import datetime
 import streamlit.components.v1 as components
 
-from database import guardar_historial_db, recuperar_historial_por_fecha, eliminar_historial_por_fecha, obtener_fecha_creacion_original
+from database import recuperar_historial_por_fecha
+from cola_escritura import encolar_guardado, estado_guardado
 from image_gen import generar_imagen_en_memoria
 from utils import selector_de_rangos, obtener_lista_horas_puntuales
+from flota import indice_flota, mascara, unidades, contar
 
-# --- WORKER (HILO) ---
-def worker_guardar_db(fecha, reporte, usuario, sobrescribir):
-    try:
-        fecha_creacion_original = None
-        if sobrescribir:
-            fecha_creacion_original = obtener_fecha_creacion_original(fecha, usuario)
-            eliminar_historial_por_fecha(fecha, usuario)
-            
-        guardar_historial_db(fecha, reporte, usuario, fecha_creacion_preservada=fecha_creacion_original)
-        print(f"✅ [Segundo Plano] Guardado completado para {usuario}")
-    except Exception as e:
-        print(f"❌ [Segundo Plano] Error: {e}")
+# --- ESTADO DEL GUARDADO (SEGUNDO PLANO) ---
+def mostrar_estado_guardado(fecha, usuario):
+    id_trabajo = st.session_state.get("trabajo_guardado")
+    if id_trabajo is None: return
+    
+    estado = estado_guardado(id_trabajo)
+    en_espera = bool(estado) and estado["estado"] in ("pendiente", "en_curso")
+    
+    @st.fragment(run_every=1 if en_espera else None)
+    def _indicador():
+        est = estado_guardado(id_trabajo)
+        if not est: return
+        if est["estado"] in ("pendiente", "en_curso"):
+            st.caption("⏳ Guardando en la base de datos...")
+        elif est["estado"] == "hecho":
+            st.caption(f"☁️ Guardado ({est['latencia']:.1f} s)")
+            # Un rerun completo para dejar de sondear
+            if en_espera: st.rerun(scope="app")
+        else:
+            st.error(f"❌ No se guardó: {est['error']}")
+            if st.button("🔁 Reintentar guardado", key="btn_reintentar_guardado"):
+                st.session_state.trabajo_guardado = encolar_guardado(fecha, st.session_state.reporte_diario, usuario)
+                st.rerun(scope="app")
+    _indicador()
 
 # --- JS SCROLL ---
 def inyectar_scroll_js():
@@ -89,11 +102,8 @@ def render_vista(usuario_actual):
     
     d = st.session_state.datos_app
     
-    all_u = []
-    if "rangos" in d:
-        for r in d["rangos"]:
-            all_u.extend(list(range(r[0], r[1] + 1)))
-    all_u = sorted(list(set(all_u)))
+    idx = indice_flota(d)
+    all_u = idx["lista"]
     
     LISTA_HORAS = obtener_lista_horas_puntuales()
     if 'ed_idx' not in st.session_state: st.session_state.ed_idx = None
@@ -115,15 +125,13 @@ def render_vista(usuario_actual):
 
     st.divider()
     
-    avs = d.get("averiadas", [])
-    op = [u for u in all_u if u not in avs]
-    ya = [u for e in st.session_state.reporte_diario for u in e['unidades']]
-    disp = [u for u in op if u not in ya]
+    ya = mascara(u for e in st.session_state.reporte_diario for u in e['unidades'])
+    disp = unidades(idx["operativas"] & ~ya)
 
     with st.container(border=True):
         m1,m2,m3 = st.columns(3)
         m1.metric("Total Flota", len(all_u))
-        m2.metric("En Taller", len(avs), delta_color="inverse")
+        m2.metric("En Taller", contar(idx["taller"]), delta_color="inverse")
         m3.metric("Disponibles", len(disp))
 
     with st.expander("➕ Nueva Asignación", expanded=True):
@@ -204,9 +212,8 @@ def render_vista(usuario_actual):
                         for x in to_rm: e['unidades'].remove(x)
                         st.rerun()
                     
-                    others = [u for ix, r in enumerate(st.session_state.reporte_diario) if ix != i for u in r['unidades']]
-                    cands = [u for u in op if u not in others and u not in e['unidades']]
-                    to_add = selector_de_rangos(cands, f"ea{i}", default_str=None)
+                    # Operativas que no estén en ninguna asignación (esta incluida)
+                    to_add = selector_de_rangos(disp, f"ea{i}", default_str=None)
                     if st.button("Agregar selección", key=f"bad{i}") and to_add:
                         e['unidades'].extend(to_add); st.rerun()
                     
@@ -281,20 +288,13 @@ def render_vista(usuario_actual):
             
             contenedor_botonera.empty()
             
-            tipo = st.session_state.accion_guardar_pendiente
             st.session_state.accion_guardar_pendiente = None 
             
             st.session_state[cache_key] = st.session_state.reporte_diario
             img = generar_imagen_en_memoria(st.session_state.reporte_diario, fr, txt_r, d)
             st.session_state.img_mem = img
             
-            sobrescribir = (tipo == "overwrite")
-            hilo = threading.Thread(
-                target=worker_guardar_db, 
-                args=(fr, st.session_state.reporte_diario, usuario_actual, sobrescribir),
-                daemon=True
-            )
-            hilo.start()
+            st.session_state.trabajo_guardado = encolar_guardado(fr, st.session_state.reporte_diario, usuario_actual)
             
             st.session_state.hacer_scroll_imagen = True
             st.toast("✅ Generado. Guardando en segundo plano...")
@@ -308,6 +308,7 @@ def render_vista(usuario_actual):
 
             st.markdown("---")
             st.success("📸 **Vista Previa Generada**")
+            mostrar_estado_guardado(fr, usuario_actual)
             st.image(st.session_state.img_mem, width=450)
             
             nombre_img = f"Reporte_{fr.strftime('%d-%m-%Y')}.png"
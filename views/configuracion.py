@@ -1,5 +1,5 @@
 import streamlit as st
-from database import guardar_datos_db
+from database import guardar_datos_db, compactar_historial
 from image_gen import generar_imagen_en_memoria
 from datetime import datetime
 
@@ -112,6 +112,16 @@ def render_vista(usuario_actual):
                             if x in d["estaciones"]: d["estaciones"].remove(x)
                         guardar(); st.rerun()
 
+        # 4. MANTENIMIENTO
+        with st.expander("🧹 4. Mantenimiento del Historial", expanded=False):
+            st.caption("Quita los días repetidos (se queda la última edición) y ordena el historial por fecha.")
+            with st.popover("Compactar historial", use_container_width=True):
+                if st.button("Sí, compactar", type="primary", use_container_width=True):
+                    with st.spinner("Compactando..."):
+                        res = compactar_historial(usuario_actual)
+                    if res is None: st.error("No se pudo compactar el historial.")
+                    else: st.success(f"Listo: {res['filas']} filas y {res['bytes'] / 1024:.1f} KB recuperados.")
+
     if col_preview:
         with col_preview:
             st.subheader("👁️ Vista Previa")
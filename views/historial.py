@@ -68,6 +68,20 @@ def convertir_a_excel(datos_historial):
     output.seek(0)
     return output
 
+# --- RESUMEN DEL PERIODO ---
+def resumen_periodo(usuario, datos_historial):
+    """
+    Total de asignaciones del periodo, recalculado solo si cambian los días
+    (fecha + última edición). Así cambiar de página no decodifica todos los
+    reportes: solo los del lote que se pinta.
+    """
+    huella = (usuario, tuple((d['fecha'], d.get('actualizado', '')) for d in datos_historial))
+    resumen = st.session_state.get("resumen_historial")
+    if resumen is None or resumen["huella"] != huella:
+        resumen = {"huella": huella, "total_asig": sum(len(d["reporte"]) for d in datos_historial), "excel": None}
+        st.session_state.resumen_historial = resumen
+    return resumen
+
 # --- CALLBACKS DE PAGINACIÓN ---
 def ir_a_pagina(n):
     st.session_state.pag_historial = n
@@ -101,16 +115,21 @@ def render_vista(usuario_actual):
         
         if datos_completos:
             total_items = len(datos_completos)
-            total_asig = sum([len(d["reporte"]) for d in datos_completos])
+            resumen = resumen_periodo(usuario_actual, datos_completos)
             
             with c_metrics:
                 m1, m2, m3 = st.columns(3)
                 m1.metric("Días Reportados", total_items)
-                m2.metric("Total Asignaciones", total_asig)
-                excel_file = convertir_a_excel(datos_completos)
-                if excel_file:
+                m2.metric("Total Asignaciones", resumen["total_asig"])
+                # El Excel se genera al pedirlo, no en cada rerun
+                if resumen["excel"] is None:
+                    if m3.button("📊 Preparar Excel", type="primary"):
+                        excel_file = convertir_a_excel(datos_completos)
+                        resumen["excel"] = excel_file.getvalue() if excel_file else b""
+                        st.rerun()
+                elif resumen["excel"]:
                     nombre_archivo = f"Reporte_{inicio.strftime('%d%m')}_{fin.strftime('%d%m')}.xlsx"
-                    m3.download_button("📥 Descargar Excel", excel_file, nombre_archivo, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", type="primary")
+                    m3.download_button("📥 Descargar Excel", resumen["excel"], nombre_archivo, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", type="primary")
             
             st.divider()
 
@@ -1,6 +1,9 @@
 import streamlit as st
 import time
-from database import guardar_datos_db
+import pandas as pd
+from database import registrar_eventos_taller, estadisticas_taller
+from utils import parsear_expresion_unidades
+from flota import indice_flota, contiene, contar, unidades, mascara
 
 # ==========================================
 # 1. CSS FINAL (CONTROL TOTAL DE PÍXELES)
@@ -128,9 +131,10 @@ def gestionar_unidad(unidad, estado_actual, datos, usuario_actual):
             st.error("Estado: 🔴 EN TALLER")
             st.write("¿La unidad ya fue reparada?")
             if st.button("✅ Habilitar Unidad", type="primary", use_container_width=True):
-                if unidad in datos["averiadas"]:
-                    datos["averiadas"].remove(unidad)
-                    guardar_datos_db(datos, usuario_actual)
+                nuevas = registrar_eventos_taller(usuario_actual, [(unidad, "reparada")])
+                if nuevas is None: st.error("No se pudo registrar. Intenta de nuevo.")
+                else:
+                    datos["averiadas"] = nuevas
                     st.toast(f"Unidad {unidad} habilitada")
                     time.sleep(0.5)
                     st.rerun()
@@ -138,17 +142,47 @@ def gestionar_unidad(unidad, estado_actual, datos, usuario_actual):
             st.success("Estado: 🚛 OPERATIVA")
             st.write("¿Deseas enviar esta unidad a mantenimiento?")
             if st.button("🛠️ Reportar Daño", type="primary", use_container_width=True):
-                if "averiadas" not in datos: datos["averiadas"] = []
-                if unidad not in datos["averiadas"]:
-                    datos["averiadas"].append(unidad)
-                    datos["averiadas"].sort()
-                    guardar_datos_db(datos, usuario_actual)
+                nuevas = registrar_eventos_taller(usuario_actual, [(unidad, "averiada")])
+                if nuevas is None: st.error("No se pudo registrar. Intenta de nuevo.")
+                else:
+                    datos["averiadas"] = nuevas
                     st.toast(f"Unidad {unidad} a taller")
                     time.sleep(0.5)
                     st.rerun()
 
 # ==========================================
-# 3. VISTA PRINCIPAL
+# 3. OPERACIÓN MASIVA
+# ==========================================
+def operacion_masiva(idx, datos, usuario_actual):
+    with st.expander("🧰 Operación masiva (varias unidades a la vez)", expanded=False):
+        accion = st.radio("Acción", ["🛠️ Enviar a taller", "✅ Habilitar"], horizontal=True, key="masivo_accion")
+        enviar = accion.startswith("🛠️")
+        
+        expr = st.text_input("Unidades (ej: 1-10, 15, 20-25)", key="masivo_expr")
+        por_expr, fuera, errores = parsear_expresion_unidades(expr, idx["flota"])
+        if errores: st.warning(f"No se entendió: {', '.join(errores)}")
+        
+        # Solo cuentan las que realmente cambian de estado
+        origen = idx["operativas"] if enviar else idx["taller"]
+        extra = st.multiselect("…o selecciona de la lista:", unidades(origen), key="masivo_sel")
+        
+        cambios = unidades((por_expr | mascara(extra)) & origen)
+        
+        if fuera: st.caption(f"{fuera} unidades fuera de la flota (se ignoran).")
+        st.caption(f"Se {'enviarán a taller' if enviar else 'habilitarán'} **{len(cambios)}** unidades.")
+        
+        if st.button("Aplicar", type="primary", use_container_width=True, disabled=not cambios, key="masivo_ok"):
+            estado = "averiada" if enviar else "reparada"
+            nuevas = registrar_eventos_taller(usuario_actual, [(u, estado) for u in cambios])
+            if nuevas is None: st.error("No se pudo registrar. Intenta de nuevo.")
+            else:
+                datos["averiadas"] = nuevas
+                for k in ("masivo_expr", "masivo_sel"): st.session_state.pop(k, None)
+                st.toast(f"{len(cambios)} unidades actualizadas")
+                st.rerun()
+
+# ==========================================
+# 4. VISTA PRINCIPAL
 # ==========================================
 def render_vista(usuario_actual):
     inyectar_css_final()
@@ -156,13 +190,10 @@ def render_vista(usuario_actual):
     st.title("🔧 Taller Central")
     
     d = st.session_state.datos_app
-    avs = d.get("averiadas", [])
-    
-    all_u = []
-    if "rangos" in d:
-        for r in d["rangos"]:
-            all_u.extend(list(range(r[0], r[1] + 1)))
-    all_u = sorted(list(set(all_u)))
+    idx = indice_flota(d)
+    all_u = idx["lista"]
+
+    operacion_masiva(idx, d, usuario_actual)
 
     columnas_por_fila = 6
     
@@ -172,7 +203,7 @@ def render_vista(usuario_actual):
         
         for j, u in enumerate(fila):
             # Python siempre manda el icono. CSS decide si lo oculta o no.
-            if u in avs:
+            if contiene(idx["taller"], u):
                 label = f"🛠️\n{u}"
                 tipo = "primary"
                 estado = "averiada"
@@ -190,4 +221,16 @@ def render_vista(usuario_actual):
         st.divider()
         c1, c2 = st.columns(2)
         c1.metric("Total", len(all_u))
-        c2.metric("Averiadas", len(avs))
+        c2.metric("Averiadas", contar(idx["taller"]))
+
+    with st.expander("📊 Estadísticas de Taller", expanded=False):
+        stats = estadisticas_taller(usuario_actual)
+        if stats:
+            df = pd.DataFrame(stats).rename(columns={
+                "unidad": "Unidad", "estado": "Estado", "desde": "Desde",
+                "reparaciones": "Reparaciones", "horas_taller": "Horas en taller",
+                "horas_media_reparacion": "Media por reparación (h)"
+            })
+            st.dataframe(df.sort_values("Horas en taller", ascending=False), hide_index=True, use_container_width=True)
+        else:
+            st.caption("Aún no hay movimientos de taller registrados.")